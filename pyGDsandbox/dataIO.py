@@ -10,13 +10,24 @@ import numpy as np
 import pandas as pd
 import os
 import ast
+import operator
+import json
+import hashlib
+import datetime
+import struct
+import shutil
+import tempfile
 from shutil import copyfile
+from collections import OrderedDict
 
 
-def df2dbf(df, dbf_path, my_specs=None):
+def df2dbf(df, dbf_path, my_specs=None, chunksize=2**16):
     '''
     Convert a pandas.DataFrame into a dbf.
 
+    Columns are formatted in bulk into fixed-width fields and the records
+    written in chunks of `chunksize` rows.
+
     __author__  = "Dani Arribas-Bel <darribas@asu.edu> "
     ...
 
@@ -28,36 +39,54 @@ def df2dbf(df, dbf_path, my_specs=None):
                   Path to the output dbf. It is also returned by the function
     my_specs    : list
                   List with the field_specs to use for each column.
-                  Defaults to None and applies the following scheme:
-                    * int: ('N', 14, 0)
-                    * float: ('N', 14, 14)
-                    * str: ('C', 14, 0)
+                  Defaults to None and fits a spec to all the values of every
+                  column:
+                    * int: ('N', digits, 0)
+                    * float: ('N', digits, decimals) with as many decimals
+                      as needed (up to 15)
+                    * bool: ('L', 1, 0)
+                    * datetime: ('D', 8, 0)
+                    * str (and anything else): ('C', longest, 0)
+    chunksize   : int
+                  Number of records formatted and written at once
+
+    Column names are cut to the 10 characters a dbf field name can hold;
+    names that become equal are told apart with a suffix (_1, _2...).
     '''
     if my_specs:
         specs = my_specs
     else:
-        type2spec = {int: ('N', 20, 0),
-                     np.int64: ('N', 20, 0),
-                     float: ('N', 36, 15),
-                     np.float64: ('N', 36, 15),
-                     str: ('C', 14, 0)
-                     }
-        types = [type(df[i].iloc[0]) for i in df.columns]
-        specs = [type2spec[t] for t in types]
-    db = ps.open(dbf_path, 'w')
-    db.header = list(df.columns)
-    db.field_spec = specs
-    for i, row in df.T.iteritems():
-        db.write(row)
+        specs = [_dbf_spec(df.iloc[:, i]) for i in range(df.shape[1])]
+    fields = [(name, t, size, dec) for name, (t, size, dec) in \
+              zip(_dbf_names(df.columns), specs)]
+    dt = np.dtype([('_deleted', 'S1')] + [('f%i' % i, 'S%i' % f[2]) for i, f
+                                          in enumerate(fields)])
+    db = open(dbf_path, 'wb', 2**20)
+    db.write(_dbf_header_bytes(fields, df.shape[0]))
+    for start in range(0, df.shape[0], chunksize):
+        chunk = df.iloc[start:start+chunksize]
+        recs = np.empty(chunk.shape[0], dtype=dt)
+        recs['_deleted'] = ' '
+        for i, spec in enumerate(specs):
+            recs['f%i' % i] = _dbf_format(chunk.iloc[:, i].values, spec)
+        db.write(recs.tostring())
+    db.write('\x1a')
     db.close()
     return dbf_path
 
 
-def dbf2df(dbf_path, index=None, cols=False, incl_index=False):
+DBF_CACHE_SIZE = 2**32
+
+
+def dbf2df(dbf_path, index=None, cols=False, incl_index=False, cache=False,
+           cache_size=DBF_CACHE_SIZE):
     '''
     Read a dbf file as a pandas.DataFrame, optionally selecting the index
     variable and which columns are to be loaded.
 
+    The records are memory-mapped as a NumPy structured array and only the
+    columns requested are converted, each in a single vectorized pass.
+
     __author__  = "Dani Arribas-Bel <darribas@asu.edu> "
     ...
 
@@ -73,27 +102,179 @@ def dbf2df(dbf_path, index=None, cols=False, incl_index=False):
     incl_index  : Boolean
                   If True index is included in the DataFrame as a
                   column too. Defaults to False
+    cache       : boolean/str
+                  If True, every column is stored decoded as a .npy file in
+                  a folder next to dbf_path (same name with extension
+                  .colcache); if a string, in a subfolder of that directory
+                  keyed by the absolute path of dbf_path. Later calls
+                  memory-map the requested columns from there instead of
+                  parsing the dbf. Caches of an older version of dbf_path
+                  (different size or mtime) are evicted and rebuilt.
+                  Defaults to False (no cache)
+    cache_size  : int
+                  Maximum size in bytes of a cache directory (only used if
+                  `cache` is a string). When exceeded, the least recently
+                  used caches in it are removed
 
     Returns
     -------
     df          : DataFrame
                   pandas.DataFrame object created
     '''
-    db = ps.open(dbf_path)
     if cols:
+        vars_to_read = list(cols)
         if incl_index:
-            cols.append(index)
-        vars_to_read = cols
+            vars_to_read.append(index)
+    else:
+        vars_to_read = None
+    if cache:
+        if cache is True:
+            path = dbf_path[:-3] + 'colcache'
+        else:
+            if not os.path.isdir(cache):
+                os.makedirs(cache)
+            key = hashlib.md5(os.path.abspath(dbf_path)).hexdigest()
+            path = os.path.join(cache, key)
+        names = vars_to_read + [index] if vars_to_read and index else \
+            vars_to_read
+        data = _cache_load(path, dbf_path, names)
+        if data is None:
+            data = _dbf_columns(dbf_path)
+            _cache_save(path, data, dbf_path)
+            if cache is not True:
+                _cache_evict(cache, cache_size, keep=path)
     else:
-        vars_to_read = db.header
-    data = dict([(var, db.by_col(var)) for var in vars_to_read])
+        data = _dbf_columns(dbf_path, vars_to_read + [index] if
+                            vars_to_read and index else vars_to_read)
+    if vars_to_read is None:
+        vars_to_read = list(data)
+    df = pd.DataFrame(dict([(var, data[var]) for var in vars_to_read]))
     if index:
-        index = db.by_col(index)
-        db.close()
-        return pd.DataFrame(data, index=index)
+        df.index = np.asarray(data[index])
+    return df
+
+
+def _dbf_columns(dbf_path, names=None):
+    '''
+    Decode columns of the live (not deleted) records of a DBF
+    ...
+
+    Arguments
+    ---------
+    dbf_path    : str
+                  Path to the DBF file to be read
+    names       : list
+                  Names of the columns to decode. Defaults to None (all)
+
+    Returns
+    -------
+    data        : OrderedDict
+                  Mapping of column names to arrays (see _dbf_decode), in
+                  file order
+    '''
+    header = _dbf_header(dbf_path)
+    recs = _dbf_records(dbf_path, header)
+    live = recs['_deleted'] != '*'
+    if not live.all():
+        recs = recs[live]
+    specs = _dbf_specs(header)
+    if names is None:
+        names = list(specs)
+    data = OrderedDict()
+    for var in names:
+        if var not in data:
+            key, ftype, size, dec = specs[var]
+            data[var] = _dbf_decode(recs[key], ftype, dec)
+    return data
+
+
+DBF_WHERE_OPS = {'==': operator.eq, '!=': operator.ne, '<': operator.lt,
+                 '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+
+
+def dbf2df_chunks(dbf_path, chunksize=2**16, index=None, cols=False,
+                  incl_index=False, where=None):
+    '''
+    Iterate over a dbf file as a sequence of pandas.DataFrames of up to
+    `chunksize` records each, optionally keeping only the records that pass
+    a filter.
+
+    The filter is evaluated on the raw bytes of the columns it involves
+    before any other column is decoded, so only the matching records of
+    the requested columns are ever converted. Character columns compared
+    with '==', '!=' or 'in' are matched directly against the padded bytes
+    stored in the file.
+    ...
+
+    Arguments
+    ---------
+    dbf_path    : str
+                  Path to the DBF file to be read
+    chunksize   : int
+                  Number of records scanned in every step. Chunks with no
+                  matching record are skipped
+    index       : str
+                  Name of the column to be used as the index of the
+                  DataFrames. Defaults to None, which uses the position of
+                  every record in the file
+    cols        : list
+                  List with the names of the columns to be read into the
+                  DataFrames. Defaults to False, which reads the whole dbf
+    incl_index  : Boolean
+                  If True index is included in the DataFrames as a
+                  column too. Defaults to False
+    where       : list
+                  Conditions a record must all meet to be returned, as
+                  (column, op, value) tuples where op is one of '==', '!=',
+                  '<', '<=', '>', '>=' or 'in' (and value a list for the
+                  latter); character columns compare as byte strings
+                  without padding. A single tuple is also accepted
+
+    Returns
+    -------
+    chunks      : generator
+                  pandas.DataFrame objects with the records that pass the
+                  filter, in file order
+
+    Example
+    -------
+    >>> for df in dbf2df_chunks('big.dbf', cols=['ID', 'VAL'],
+    ...                         where=[('STATE', 'in', ['AZ', 'NM']),
+    ...                                ('VAL', '>', 0)]):
+    ...     process(df)
+    '''
+    header = _dbf_header(dbf_path)
+    specs = _dbf_specs(header)
+    recs = _dbf_records(dbf_path, header)
+    if cols:
+        vars_to_read = list(cols)
+        if incl_index:
+            vars_to_read.append(index)
     else:
-        db.close()
-        return pd.DataFrame(data)
+        vars_to_read = list(specs)
+    if where and not isinstance(where[0], (list, tuple)):
+        where = [where]
+    tests = [_dbf_where(specs[col], op, value) for col, op, value in
+             where or []]
+
+    def _read(raw, var):
+        key, ftype, size, dec = specs[var]
+        return _dbf_decode(raw[key], ftype, dec)
+    for start in range(0, header['n'], chunksize):
+        chunk = recs[start:start+chunksize]
+        keep = chunk['_deleted'] != '*'
+        for col, test in tests:
+            keep &= test(chunk[col])
+        ids = np.flatnonzero(keep)
+        if not ids.size:
+            continue
+        if ids.size < chunk.shape[0]:
+            chunk = chunk[ids]
+        data = dict([(var, _read(chunk, var)) for var in vars_to_read])
+        if index:
+            yield pd.DataFrame(data, index=_read(chunk, index))
+        else:
+            yield pd.DataFrame(data, index=ids + start)
 
 
 def appendcol2dbf(dbf_in, dbf_out, col_name, col_spec, col_data,
@@ -158,7 +339,8 @@ def appendcol2dbf(dbf_in, dbf_out, col_name, col_spec, col_data,
     >>> appendcol2dbf(dbf_in,dbf_out,col_name,col_spec,col_data)
 
     This will output a second DBF that can then be used to replace the
-    original DBF (this will often be the case when working with shapefiles). I
+    original DBF (this will often be the case when working with shapefiles).
+    To add, replace or drop several columns in one go, see editcols2dbf. I
     figured it would be more prudent to have the function by default create a
     second file which the user can then inspect and manually replace if they
     want rather than just blindly overwriting the original. The latter is an
@@ -167,37 +349,118 @@ def appendcol2dbf(dbf_in, dbf_out, col_name, col_spec, col_data,
 
     """
 
-    # open the original dbf and create a new one with the new field
-    db = ps.open(dbf_in)
-    db_new = ps.open(dbf_out, 'w')
-    db_new.header = db.header
-    db_new.header.append(col_name)
-    db_new.field_spec = db.field_spec
-    db_new.field_spec.append(col_spec)
-
-    # populate the dbf with the original and new data
-    item = 0
-    for rec in db:
-        rec_new = rec
-        rec_new.append(col_data[item])
-        db_new.write(rec_new)
-        item += 1
-
-    # close the files
-    db_new.close()
-    db.close()
-
-    # the following text will delete the old dbf and replace it with the new
-    #one retaining the name of the original file.
     if replace is True:
-        os.remove(dbf_in)
-        os.rename(dbf_out, dbf_in)
+        editcols2dbf(dbf_in, add=[(col_name, col_spec, col_data)])
+        return
+    editcols2dbf(dbf_in, add=[(col_name, col_spec, col_data)],
+                 dbf_out=dbf_out)
+
+    # copy shp and shx so dbf_out is a shapefile too
+    for ext in ['.shp', '.shx']:
+        if not os.path.exists(dbf_out[:-4] + ext):
+            copyfile(dbf_in[:-4] + ext, dbf_out[:-4] + ext)
+
+
+def editcols2dbf(dbf_in, add=None, drop=None, dbf_out=None,
+                 chunksize=2**16):
+    '''
+    Add, replace and drop any number of columns of a DBF in a single pass
+    over its records.
+
+    The records are streamed in chunks: retained fields are copied as raw
+    bytes and new ones formatted in bulk. The result is written to a
+    temporary file that then atomically takes the place of the output, so
+    readers never see a half-written DBF. Only the DBF is touched, the rest
+    of the shapefile is left as is.
+    ...
+
+    Arguments
+    ---------
+    dbf_in      : str
+                  Path to the DBF to be edited
+    add         : list
+                  List of (col_name, col_spec, col_data) tuples with the
+                  columns to add. col_spec is a (type, len, precision) tuple
+                  as in appendcol2dbf or None to fit one to col_data (see
+                  df2dbf) and col_data must have one value per record. If
+                  col_name is already in the DBF, the column is replaced in
+                  its position. Names must have 1 to 10 ASCII characters
+                  and appear once in the list (ValueError otherwise).
+    drop        : list
+                  Names of the columns to remove
+    dbf_out     : str
+                  [Optional] Path to the DBF to write. If None (default),
+                  dbf_in is replaced
+    chunksize   : int
+                  Number of records rewritten at once
+
+    Returns
+    -------
+    dbf_out     : str
+                  Path to the DBF written
+    '''
+    if dbf_out is None:
+        dbf_out = dbf_in
+    drop = set(drop or [])
+    header = _dbf_header(dbf_in)
+    n = header['n']
+    new = OrderedDict()
+    for col_name, col_spec, col_data in add or []:
+        col_name = _dbf_check_name(col_name)
+        if col_name in new:
+            raise ValueError("Column %s added more than once" % col_name)
+        if len(col_data) != n:
+            raise ValueError("Column %s has %i values for %i records" %
+                             (col_name, len(col_data), n))
+        col_data = np.asarray(col_data)
+        if col_spec is None:
+            col_spec = _dbf_spec(pd.Series(col_data))
+        new[col_name] = (tuple(col_spec), col_data)
+    # (name, type, size, dec, source) with source the key of the field in the
+    # records of dbf_in (see _dbf_dtype) or the data of a new column
+    fields = []
+    for i, (name, ftype, size, dec) in enumerate(header['fields']):
+        if name in drop:
+            continue
+        if name in new:
+            spec, data = new.pop(name)
+            fields.append((name, ) + spec + (data, ))
+        else:
+            fields.append((name, ftype, size, dec, 'f%i' % i))
+    for name, (spec, data) in new.items():
+        fields.append((name, ) + spec + (data, ))
+    dt = np.dtype([('_deleted', 'S1')] + [('f%i' % i, 'S%i' % f[2]) for
+                                          i, f in enumerate(fields)])
+    recs = _dbf_records(dbf_in, header)
+    fd, tmp = tempfile.mkstemp(suffix='.dbf',
+                               dir=os.path.dirname(os.path.abspath(dbf_out)))
+    try:
+        out = os.fdopen(fd, 'wb', 2**20)
+        out.write(_dbf_header_bytes([f[:4] for f in fields], n))
+        for start in range(0, n, chunksize):
+            chunk = recs[start:start+chunksize]
+            out_recs = np.empty(chunk.shape[0], dtype=dt)
+            out_recs['_deleted'] = chunk['_deleted']
+            for i, f in enumerate(fields):
+                if isinstance(f[4], str):
+                    out_recs['f%i' % i] = chunk[f[4]]
+                else:
+                    out_recs['f%i' % i] = _dbf_format(
+                        f[4][start:start+chunksize], f[1:4])
+            out.write(out_recs.tostring())
+        out.write('\x1a')
+        out.close()
+        recs = chunk = None
+        shutil.copymode(dbf_in, tmp)
+        if os.name == 'nt' and os.path.exists(dbf_out):
+            os.remove(dbf_out)
+        os.rename(tmp, dbf_out)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return dbf_out
 
-    # copy shp and shx
-    if not os.path.exists(dbf_out[:-4] + '.shp'):
-        copyfile(dbf_in[:-4] + '.shp', dbf_out[:-4] + '.shp')
-    if not os.path.exists(dbf_out[:-4] + '.shx'):
-        copyfile(dbf_in[:-4] + '.shx', dbf_out[:-4] + '.shx')
 
 def exclude_fe(txt, prefixes):
     '''
@@ -430,14 +693,557 @@ def updatelisashp(lm, shp, alpha=0.05, norm=False):
     for i in sig_ids:
         data_q[i] = lm.q[i]
 
-    # prep parameters for changing the dbf
-    dbf_in = shp + ".dbf"
-    dbf_out = shp + "_copy.dbf"
-    col_name = ['quadrat', 'pvalue']
-    col_spec = [('N', 9, 0), ('F', 10, 8)]
-    col_data = [data_q, data_p]
-
-    # add the quadrat and pvalue columns to the data
-    for i in range(2):
-        appendcol2dbf(dbf_in, dbf_out, col_name[i], col_spec[i], col_data[i],
-                      replace=True)
+    # add the quadrat and pvalue columns to the data in a single rewrite
+    editcols2dbf(shp + ".dbf", add=[('quadrat', ('N', 9, 0), data_q),
+                                    ('pvalue', ('F', 10, 8), data_p)])
+
+
+def _file_sig(path):
+    '''
+    Signature identifying the current state of a file: absolute path, size
+    and modification time
+    '''
+    st = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': st.st_size,
+            'mtime': st.st_mtime}
+
+
+def _cache_save(cache_path, arrays, src):
+    '''
+    Store a set of arrays in a cache folder tied to the state of a source file
+    ...
+
+    Arguments
+    ---------
+    cache_path  : str
+                  Path to the folder of the cache. It is (re)created
+                  atomically so readers never find it half-written; if
+                  several processes write it at once, the first one wins
+    arrays      : dict
+                  Mapping of names to numpy arrays. Each is written as
+                  `name`.npy so it can be memory-mapped later on
+    src         : str
+                  Path to the file the cache is derived from. Its signature is
+                  stored in the cache to detect stale copies
+    '''
+    parent = os.path.dirname(os.path.abspath(cache_path))
+    tmp = tempfile.mkdtemp(dir=parent)
+    try:
+        for name, a in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), a)
+        meta = open(os.path.join(tmp, 'meta.json'), 'w')
+        json.dump({'src': _file_sig(src), 'arrays': list(arrays)}, meta)
+        meta.close()
+        if os.path.exists(cache_path):
+            shutil.rmtree(cache_path, ignore_errors=True)
+        try:
+            os.rename(tmp, cache_path)
+        except OSError:
+            # Another writer (e.g. a worker loading the same file) put its
+            # cache in place first: keep that one and drop this copy
+            if not os.path.isdir(cache_path):
+                raise
+            shutil.rmtree(tmp, ignore_errors=True)
+    except:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+
+def _cache_load(cache_path, src, names=None):
+    '''
+    Memory-map the arrays in a cache folder written by _cache_save. If the
+    cache is stale (`src` has changed since it was written) or broken, it is
+    evicted from disk. Valid caches are touched so _cache_evict can tell
+    which were used last
+    ...
+
+    Arguments
+    ---------
+    cache_path  : str
+                  Path to the folder of the cache
+    src         : str
+                  Path to the file the cache is derived from
+    names       : list
+                  Names of the arrays to load. Defaults to None (all of them)
+
+    Returns
+    -------
+    arrays      : dict
+                  Mapping of names to read-only memory-mapped arrays. None if
+                  there is no valid cache for the current state of `src`
+    '''
+    try:
+        meta = json.load(open(os.path.join(cache_path, 'meta.json')))
+    except (IOError, OSError, ValueError):
+        return None
+    try:
+        if meta['src'] != _file_sig(src):
+            raise ValueError('Stale cache')
+        if names is None:
+            names = meta['arrays']
+        arrays = dict([(name, np.load(os.path.join(cache_path, name + '.npy'),
+                                      mmap_mode='r'))
+                       for name in names if name in meta['arrays']])
+        os.utime(os.path.join(cache_path, 'meta.json'), None)
+        return arrays
+    except (IOError, OSError, ValueError, KeyError):
+        shutil.rmtree(cache_path, ignore_errors=True)
+        return None
+
+
+def _cache_evict(cache_dir, max_bytes, keep=None):
+    '''
+    Remove the least recently used caches in a folder until all of them
+    together take up no more than `max_bytes`
+    ...
+
+    Arguments
+    ---------
+    cache_dir   : str
+                  Folder holding caches written by _cache_save as subfolders
+    max_bytes   : int
+                  Maximum size on disk of all the caches in cache_dir
+    keep        : str
+                  Path to a cache that is never evicted (e.g. the one just
+                  written)
+    '''
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        try:
+            used = os.stat(os.path.join(path, 'meta.json')).st_mtime
+            size = sum([os.stat(os.path.join(path, f)).st_size
+                        for f in os.listdir(path)])
+        except OSError:
+            continue
+        entries.append((used, size, path))
+    total = sum([e[1] for e in entries])
+    keep = os.path.abspath(keep) if keep else None
+    for used, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if os.path.abspath(path) == keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def _dbf_header(dbf_path):
+    '''
+    Parse the header of a DBF file
+    ...
+
+    Arguments
+    ---------
+    dbf_path    : str
+                  Path to the DBF file
+
+    Returns
+    -------
+    header      : dict
+                  Number of records ('n'), length in bytes of the header
+                  ('header_len') and of every record ('record_len'), fields as
+                  a list of (name, type, size, decimals) tuples ('fields') and
+                  the raw bytes of the header ('raw')
+    '''
+    f = open(dbf_path, 'rb')
+    raw = f.read(32)
+    n, header_len, record_len = struct.unpack('<4xIHH', raw[:12])
+    raw += f.read(header_len - 32)
+    f.close()
+    fields = []
+    for i in range(32, header_len - 1, 32):
+        d = raw[i:i+32]
+        if d[0] == '\r' or len(d) < 32:
+            break
+        fields.append((d[:11].split('\0')[0], d[11], ord(d[16]), ord(d[17])))
+    return {'n': n, 'header_len': header_len, 'record_len': record_len,
+            'fields': fields, 'raw': raw}
+
+
+def _dbf_dtype(header):
+    '''
+    NumPy structured dtype of the records of a DBF: a 'S1' deletion flag
+    ('_deleted') followed by one fixed-width string per field. Fields are
+    named by position ('f0', 'f1'...), as DBF field names may repeat (see
+    _dbf_specs)
+    '''
+    names, formats, offsets = ['_deleted'], ['S1'], [0]
+    pos = 1
+    for i, (name, ftype, size, dec) in enumerate(header['fields']):
+        names.append('f%i' % i)
+        formats.append('S%i' % size)
+        offsets.append(pos)
+        pos += size
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+                     'itemsize': header['record_len']})
+
+
+def _dbf_specs(header):
+    '''
+    Mapping of the names of the fields of a DBF to (key, type, size,
+    decimals) tuples, with key the name of the field in its records (see
+    _dbf_dtype). If several fields share a name, the last one is used (as
+    pysal's by_col does), in the position of the first
+    '''
+    specs = OrderedDict()
+    for i, (name, ftype, size, dec) in enumerate(header['fields']):
+        specs[name] = ('f%i' % i, ftype, size, dec)
+    return specs
+
+
+def _dbf_records(dbf_path, header=None):
+    '''
+    Memory-map the records of a DBF as a structured array (see _dbf_dtype).
+    Nothing is read from disk until the records or columns are used.
+    '''
+    if header is None:
+        header = _dbf_header(dbf_path)
+    dt = _dbf_dtype(header)
+    if not header['n']:
+        return np.zeros(0, dtype=dt)
+    return np.memmap(dbf_path, dtype=dt, mode='r',
+                     offset=header['header_len'], shape=(header['n'],))
+
+
+def _dbf_decode(raw, ftype, dec):
+    '''
+    Vectorized conversion of the raw bytes of a DBF column into values
+    ...
+
+    Arguments
+    ---------
+    raw         : np.array
+                  Fixed-width string array with the column as stored
+    ftype       : str
+                  DBF type of the field ('N', 'F', 'C', 'L', 'D'...)
+    dec         : int
+                  Number of decimals of the field
+
+    Returns
+    -------
+    col         : np.array
+                  Numeric fields as int64 if they have no decimals and no
+                  missing values, float64 otherwise (missing as NaN);
+                  character fields as str without trailing padding; logical
+                  fields as 'T', 'F' or '?' (as pysal does); dates as
+                  datetime64 (NaT if missing). Anything else is returned as
+                  str without trailing padding.
+    '''
+    if ftype not in 'NFLD':
+        return np.char.rstrip(np.asarray(raw)).astype(str)
+    col = np.char.strip(np.asarray(raw))
+    if ftype in 'NF':
+        try:
+            col = np.where(col == '', 'nan', col).astype(float)
+        except ValueError:
+            col = pd.to_numeric(pd.Series(col), errors='coerce').values
+        if dec == 0 and col.size and np.isfinite(col).all():
+            col = col.astype(np.int64)
+        return col
+    if ftype == 'L':
+        out = np.repeat('?', col.shape[0])
+        out[np.in1d(col, ['Y', 'y', 'T', 't'])] = 'T'
+        out[np.in1d(col, ['N', 'n', 'F', 'f'])] = 'F'
+        return out
+    return pd.to_datetime(pd.Series(col), format='%Y%m%d',
+                          errors='coerce').values
+
+
+def _dbf_col(dbf_path, col_name, header=None):
+    '''
+    Read and decode one column of a DBF (see _dbf_decode)
+    '''
+    if header is None:
+        header = _dbf_header(dbf_path)
+    specs = _dbf_specs(header)
+    if col_name not in specs:
+        raise KeyError("Column %s not in %s" % (col_name, dbf_path))
+    key, ftype, size, dec = specs[col_name]
+    return _dbf_decode(_dbf_records(dbf_path, header)[key], ftype, dec)
+
+
+def _dbf_where(spec, op, value):
+    '''
+    Build the test for one condition of dbf2df_chunks
+    ...
+
+    Arguments
+    ---------
+    spec        : tuple
+                  (key, type, size, decimals) of the column to test, as in
+                  _dbf_specs
+    op          : str
+                  One of DBF_WHERE_OPS or 'in'
+    value       : object
+                  Value to compare the column to (list of values for 'in')
+
+    Returns
+    -------
+    test        : tuple
+                  Key of the column and function that takes its raw bytes
+                  (as returned by _dbf_records) and returns a boolean array
+    '''
+    key, ftype, size, dec = spec
+    if op != 'in' and op not in DBF_WHERE_OPS:
+        raise ValueError("Unknown operator %s" % op)
+    if ftype == 'C' and op in ('==', '!=', 'in'):
+        # Match the stored bytes, whether padded with blanks or nulls
+        values = [value] if op != 'in' else list(value)
+        values = [v.encode('utf-8') if isinstance(v, unicode) else str(v)
+                  for v in values]
+        values = np.array([v.ljust(size) for v in values if len(v) <= size] +
+                          [v for v in values if len(v) <= size] or
+                          ['-' * (size + 1)],
+                          dtype='S%i' % (size + 1))
+
+        def test(raw):
+            hit = np.in1d(raw, values)
+            return ~hit if op == '!=' else hit
+        return key, test
+    if ftype == 'D' and op != 'in':
+        value = np.datetime64(pd.Timestamp(value))
+    elif ftype == 'C' and isinstance(value, unicode):
+        # Ranges on character columns compare the bytes without padding
+        value = value.encode('utf-8')
+
+    def test(raw):
+        col = _dbf_decode(raw, ftype, dec)
+        if op == 'in':
+            return np.in1d(col, list(value))
+        return DBF_WHERE_OPS[op](col, value)
+    return key, test
+
+
+def _dbf_subset(dbf_in, dbf_out, ids, chunksize=2**16):
+    '''
+    Copy the records at positions `ids` of a DBF into a new DBF, byte by
+    byte and with the same fields
+    ...
+
+    Arguments
+    ---------
+    dbf_in      : str
+                  Path to the input DBF
+    dbf_out     : str
+                  Path to the DBF to be created
+    ids         : np.array
+                  Positions of the records to copy, in output order
+    chunksize   : int
+                  Number of records copied at once
+    '''
+    header = _dbf_header(dbf_in)
+    recs = np.memmap(dbf_in, dtype=(np.void, header['record_len']), mode='r',
+                     offset=header['header_len'], shape=(header['n'],)) \
+        if header['n'] else np.zeros(0, dtype=(np.void, header['record_len']))
+    out = open(dbf_out, 'wb', 2**20)
+    out.write(header['raw'][:4] + struct.pack('<I', len(ids)) + \
+              header['raw'][8:])
+    for i in range(0, len(ids), chunksize):
+        out.write(recs[ids[i:i+chunksize]].tostring())
+    out.write('\x1a')
+    out.close()
+    return dbf_out
+
+
+# Max. width of the numeric fields created by _dbf_spec
+DBF_MAX_NUM_WIDTH = 36
+
+
+def _dbf_spec(col):
+    '''
+    DBF field spec (type, size, decimals) able to hold all the values of a
+    column (see df2dbf)
+    '''
+    v = col.values
+    kind = v.dtype.kind
+    if kind == 'O':
+        nonnull = col.dropna()
+        inferred = pd.api.types.infer_dtype(nonnull)
+        if not len(nonnull):
+            return ('C', 1, 0)
+        if inferred in ('integer', 'floating', 'mixed-integer-float',
+                        'decimal'):
+            v = nonnull.values.astype(float)
+            kind = 'f'
+            if inferred == 'integer':
+                v = v.astype(np.int64)
+                kind = 'i'
+        elif inferred == 'boolean':
+            kind = 'b'
+        elif inferred in ('datetime', 'datetime64', 'date'):
+            kind = 'M'
+    if kind == 'b':
+        return ('L', 1, 0)
+    if kind == 'M':
+        return ('D', 8, 0)
+    if kind in 'iu':
+        if not v.size:
+            return ('N', 1, 0)
+        return ('N', max(len(str(v.min())), len(str(v.max()))), 0)
+    if kind == 'f':
+        v = v[np.isfinite(v)]
+        if not v.size:
+            return ('N', 1, 0)
+        dec = 15
+        for d in range(16):
+            if (np.round(v, d) == v).all():
+                dec = d
+                break
+        ints = len('%.0f' % np.floor(np.abs(v).max())) + (v.min() < 0)
+        dec = max(0, min(dec, DBF_MAX_NUM_WIDTH - ints - 1))
+        return ('N', ints + (dec + 1 if dec else 0), dec)
+    size = np.char.str_len(_dbf_str(v)).max() if v.size else 1
+    return ('C', int(min(max(size, 1), 254)), 0)
+
+
+def _dbf_str(values):
+    'Values as a byte string array (unicode encoded as utf-8)'
+    values = np.asarray(values)
+    if values.dtype.kind == 'S':
+        return values
+    if values.dtype.kind == 'U':
+        return np.char.encode(values, 'utf-8')
+    inferred = pd.api.types.infer_dtype(values)
+    if inferred == 'string':
+        return values.astype(str)
+    if inferred == 'unicode':
+        return np.char.encode(values.astype(unicode), 'utf-8')
+    return np.array([x.encode('utf-8') if isinstance(x, unicode) else str(x)
+                     for x in values], dtype=str)
+
+
+def _pad(raw, size):
+    'Fixed-width byte strings of `size`, truncated or padded with blanks'
+    raw = np.ascontiguousarray(raw.astype('S%i' % size))
+    b = raw.view(np.uint8).reshape((-1, size))
+    b[b == 0] = 32
+    return raw
+
+
+def _fixed_digits(scaled, size, dec):
+    '''
+    Vectorized right-aligned formatting of integers as fixed-width numbers
+    with `dec` implied decimals (e.g. 1234 with dec=2 is ' 12.34' in size 6)
+    '''
+    n = scaled.shape[0]
+    out = np.empty((n, size), dtype=np.uint8)
+    out.fill(32)
+    neg = scaled < 0
+    rem = np.abs(scaled)
+    ndig = np.searchsorted(10 ** np.arange(19, dtype=np.int64), rem,
+                           side='right')
+    ndig = np.maximum(ndig, dec + 1)
+    sign = size - 1 - ndig - (1 if dec else 0)
+    if n and (sign + (~neg)).min() < 0:
+        raise ValueError("Values do not fit in fields of size %i" % size)
+    col = size - 1
+    for t in range(ndig.max() if n else 0):
+        if dec and t == dec:
+            out[:, col] = 46
+            col -= 1
+        m = t < ndig
+        out[m, col] = 48 + (rem[m] % 10)
+        rem //= 10
+        col -= 1
+    out[np.flatnonzero(neg), sign[neg]] = 45
+    return out.view('S%i' % size).ravel()
+
+
+def _dbf_format(values, spec):
+    '''
+    Vectorized formatting of a column of values into the fixed-width bytes
+    of a DBF field. Missing values are left blank.
+    ...
+
+    Arguments
+    ---------
+    values      : array-like
+                  Values of the column
+    spec        : tuple
+                  Field spec as (type, size, decimals)
+
+    Returns
+    -------
+    raw         : np.array
+                  Byte string array of width size
+    '''
+    ftype, size, dec = spec
+    v = pd.Series(np.asarray(values))
+    missing = v.isnull().values
+    if ftype in 'NF':
+        num = pd.to_numeric(v, errors='coerce').values.astype(float)
+        missing |= ~np.isfinite(num)
+        num[missing] = 0
+        scaled = np.round(num * 10. ** dec)
+        if np.abs(scaled).max() < 2.**62 if scaled.size else True:
+            raw = _fixed_digits(scaled.astype(np.int64), size, dec)
+        else:
+            raw = np.char.mod('%.' + str(dec) + 'f', num)
+            if np.char.str_len(raw).max() > size:
+                raise ValueError("Values do not fit in field %s" % str(spec))
+            raw = np.char.rjust(raw, size).astype('S%i' % size)
+        raw[missing] = ' ' * size
+        return raw
+    if ftype == 'L':
+        raw = np.where(v.values.astype(bool), 'T', 'F')
+        raw[missing] = '?'
+    elif ftype == 'D':
+        raw = pd.to_datetime(v).dt.strftime('%Y%m%d').values.astype(str)
+        raw[missing] = ''
+    else:
+        raw = _dbf_str(v.values)
+        raw[missing] = ''
+    return _pad(raw, size)
+
+
+def _dbf_names(names):
+    '''
+    Field names of a DBF for a list of column names: cut to 10 characters
+    and, if two become equal, the later ones suffixed with _1, _2...
+    '''
+    out, seen = [], set()
+    for name in names:
+        name = str(name)[:10]
+        new, i = name, 0
+        while new in seen:
+            i += 1
+            suffix = '_%i' % i
+            new = name[:10 - len(suffix)] + suffix
+        seen.add(new)
+        out.append(new)
+    return out
+
+
+def _dbf_check_name(name):
+    '''
+    Return name as a DBF field name (str), raising ValueError unless it has
+    1 to 10 ASCII characters
+    '''
+    try:
+        field = str(name)
+    except UnicodeEncodeError:
+        field = None
+    if not field or len(field) > 10 or '\0' in field or \
+            max([ord(c) for c in field]) > 127:
+        raise ValueError("Invalid dbf field name %r: it must have 1 to 10 "
+                         "ASCII characters" % (name, ))
+    return field
+
+
+def _dbf_header_bytes(fields, n):
+    '''
+    Raw header of a DBF with `n` records and `fields` as a list of (name,
+    type, size, decimals) tuples
+    '''
+    long_names = [f[0] for f in fields if len(f[0]) > 10]
+    if long_names:
+        raise ValueError("Field names longer than 10 characters: %s" %
+                         ', '.join(long_names))
+    today = datetime.date.today()
+    head = struct.pack('<4BIHH20x', 3, today.year - 1900, today.month,
+                       today.day, n, 32 * (len(fields) + 1) + 1,
+                       1 + sum([f[2] for f in fields]))
+    for name, ftype, size, dec in fields:
+        head += struct.pack('<11sc4xBB14x', name, ftype, size, dec)
+    return head + '\r'
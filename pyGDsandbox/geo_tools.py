@@ -2,22 +2,72 @@
 Tools work with geographical data
 '''
 
-import os, time
+import os, re, time, hashlib, struct, itertools, tempfile, threading
 import pysal as ps
 import numpy as np
 import pandas as pd
 import multiprocessing as mp
+from mmap import mmap, ACCESS_READ
+from shutil import copyfile
+from collections import namedtuple, OrderedDict
+from scipy.spatial import cKDTree
 from scipy.spatial.distance import cdist
+from dataIO import df2dbf, editcols2dbf, _cache_save, _cache_load, \
+        _file_sig, _dbf_header, _dbf_records, _dbf_decode, _dbf_col, \
+        _dbf_subset, _dbf_format, _dbf_header_bytes, _dbf_spec, _dbf_specs, \
+        _dbf_check_name
+try:
+    import resource
+except ImportError:
+    resource = None
 try:
     from ogr import osr
 except:
     print ("WARNING: GDAL (and ogr) are not installed. This may create",
             "some methods to not work")
  
+# Max. number of point-edge pairs evaluated at once in vectorized ray casting
+PIP_BLOCK_SIZE = 2**20
+# Number of points sent at once to each worker of a pip_pool
+PIP_CHUNK_SIZE = 2**16
+# Max. number of polygon layers loaded on demand kept by each pip_pool worker
+PIP_POOL_LAYERS = 2
+# Polygons with more (non-horizontal) edges than this are ray cast through
+# an index of their edges by horizontal slabs (see _edge_slabs)
+PIP_SLAB_EDGES = 256
+# Max. number of children of every node of the R-tree over polygon bounding
+# boxes (see _bbox_tree)
+PIP_TREE_NODE = 4
+# Max. number of (point, polygon) candidate pairs generated at once
+PIP_PAIRS_SIZE = 2**20
+
+# Bits per axis of the grid Hilbert keys are computed on (hilbert_sort_shp and
+# the R-tree of the point in polygon functions)
+HILBERT_ORDER = 16
+
+# Number of distances computed at once by each process in dist_A2B
+DIST_BLOCK_CELLS = 2**22
+
+# Metrics of dist_A2B served by a KD-tree when nearestK is set, and the
+# Minkowski p-norm they correspond to
+KNN_METRICS = {'euclidean': 2, 'cityblock': 1, 'chebyshev': np.inf}
+
+# Flat array representation of a set of polygons:
+#   * bbs: mx4 array with left, lower, right, upper of each polygon
+#   * coords: Nx2 array with the vertices of every ring, one after another
+#   * ring_off: offsets of each ring into coords (length R+1)
+#   * geom_off: offsets of each polygon into ring_off (length m+1)
+#   * tree_bbs, tree_off, tree_items: packed R-tree over bbs (see _bbox_tree)
+_PolyArrays = namedtuple('_PolyArrays', ['bbs', 'coords', 'ring_off', 'geom_off',
+    'tree_bbs', 'tree_off', 'tree_items'])
 
 def clip_shp(shp_in, col_name, keys, shp_out=None):
     '''
     Clip out part of a shapefile based on a subset of one of the dbf columns.
+
+    Records are copied as raw bytes (located through the .shx offsets in the
+    .shp and at fixed width in the .dbf), so no geometry is decoded; only
+    headers, bounding box and the .shx index are rewritten.
     ...
 
     Arguments
@@ -45,28 +95,652 @@ def clip_shp(shp_in, col_name, keys, shp_out=None):
     keys = k
     if not shp_out:
         shp_out = shp_in[:-4] + '_clipped.shp'
-    dbi = ps.open(shp_in[:-3] + 'dbf')
-    dbo = ps.open(shp_out[:-3] + 'dbf', 'w')
-    dbo.header = dbi.header
-    dbo.field_spec = dbi.field_spec
-    shpi = ps.open(shp_in)
-    shpo = ps.open(shp_out, 'w')
-    col = np.array(dbi.by_col(col_name))
-    full = pd.DataFrame({'full': np.array(dbi.by_col(col_name))})
-    subset = pd.DataFrame({'sub': keys}, index=keys)
-    to_clip = full.join(subset, on='full').dropna().index.astype(int)
-    for i in to_clip:
-        dbo.write(dbi[i][0])
-        shpo.write(shpi.get(i))
-    shpo.close()
-    shpi.close()
-    dbo.close()
-    dbi.close()
-    os.system('cp %s %s'%(shp_in[:-3]+'prj', shp_out[:-3]+'prj'))
+    col = _dbf_col(shp_in[:-3] + 'dbf', col_name)
+    to_clip = np.flatnonzero(pd.Series(col).isin(keys).values)
+    _shp_subset(shp_in, shp_out, to_clip)
+    _dbf_subset(shp_in[:-3] + 'dbf', shp_out[:-3] + 'dbf', to_clip)
+    if os.path.exists(shp_in[:-3] + 'prj'):
+        copyfile(shp_in[:-3] + 'prj', shp_out[:-3] + 'prj')
+    return shp_out
+
+def partition_shp(shp_in, col_name, out_dir=None, max_open=64,
+        chunksize=2**16):
+    '''
+    Split a shapefile into one shapefile per value of one of the dbf columns
+    in a single sequential pass over the input
+
+    Every record is routed to the .shp/.shx/.dbf(/.prj) set of its value as
+    raw bytes (as in clip_shp). Only `max_open` output sets are kept open at
+    a time, the least recently used being closed (and reopened in append
+    mode if needed later).
+    ...
+
+    Arguments
+    =========
+    shp_in      : str
+                  Path to the shapefile to be partitioned
+    col_name    : str
+                  Name of the column to partition by
+    out_dir     : str
+                  [Optional] Folder where to write the partitions. If None,
+                  they are written next to shp_in. Each partition is named
+                  as shp_in plus '_' and the value of col_name
+    max_open    : int
+                  Max. number of output shapefiles open at once. Defaults to
+                  64
+    chunksize   : int
+                  Number of records read and routed at once. Defaults to
+                  2**16
+    Returns
+    =======
+    shp_outs    : dict
+                  Mapping of every value of col_name to the path of its
+                  shapefile
+    '''
+    if not out_dir:
+        out_dir = os.path.dirname(shp_in)
+    base = os.path.join(out_dir, os.path.basename(shp_in)[:-4])
+    dbh = _dbf_header(shp_in[:-3] + 'dbf')
+    specs = _dbf_specs(dbh)
+    if col_name not in specs:
+        raise KeyError("Column %s not in %s" % (col_name, shp_in))
+    field, ftype, size, dec = specs[col_name]
+    recs = _dbf_records(shp_in[:-3] + 'dbf', dbh)
+    raw = recs.view((np.void, dbh['record_len']))
+    offsets, lengths = _read_shx(shp_in)
+    f = open(shp_in, 'rb')
+    header = f.read(100)
+    buf = mmap(f.fileno(), 0, access=ACCESS_READ)
+    prj = shp_in[:-3] + 'prj'
+    writers, shp_outs, names = {}, {}, set()
+    opened = OrderedDict()
+    for start in range(0, offsets.shape[0], chunksize):
+        col = _dbf_decode(recs[field][start:start+chunksize], ftype, dec)
+        codes, uniq = pd.factorize(col)
+        uniq = list(uniq) + [None]
+        order = np.argsort(codes, kind='mergesort')
+        bounds = np.flatnonzero(np.diff(codes[order])) + 1
+        for grp in np.split(order, bounds):
+            if not grp.size:
+                continue
+            key = uniq[codes[grp[0]]]
+            if key not in writers:
+                name = re.sub(r'[^\w\-.]', '_', str(key))
+                while name in names:
+                    name += '_'
+                names.add(name)
+                shp_outs[key] = '%s_%s.shp' % (base, name)
+                writers[key] = _ShpWriter(shp_outs[key], header, dbh['raw'])
+                if os.path.exists(prj):
+                    copyfile(prj, shp_outs[key][:-3] + 'prj')
+            w = writers[key]
+            opened.pop(key, None)
+            opened[key] = w
+            if len(opened) > max_open:
+                opened.popitem(last=False)[1].suspend()
+            for i in grp + start:
+                o = offsets[i] + 8
+                w.write(buf[o:o+lengths[i]], _rec_bbox(buf, o),
+                        raw[i].tostring())
+    for w in writers.values():
+        w.close()
+    buf.close()
+    f.close()
+    return shp_outs
+
+def _read_shx(shp_path):
+    '''
+    Read the .shx of a shapefile
+    ...
+
+    Arguments
+    ---------
+    shp_path    : str
+                  Path to the .shp (the .shx is expected next to it)
+
+    Returns
+    -------
+    offsets     : np.array
+                  Byte offset of every record in the .shp (its 8-byte header
+                  included)
+    lengths     : np.array
+                  Length in bytes of the content of every record (its 8-byte
+                  header excluded)
+    '''
+    shx = open(shp_path[:-3] + 'shx', 'rb')
+    shx.seek(100)
+    idx = np.fromfile(shx, dtype='>i4').reshape((-1, 2)).astype(np.int64) * 2
+    shx.close()
+    return idx[:, 0], idx[:, 1]
+
+def _shx_index(shp_path):
+    '''
+    Memory-mapped view of the .shx of a shapefile as an (n, 2) array of
+    big-endian int32 (offset, content length) pairs, both in 16-bit words
+    (see _read_shx for the values in bytes)
+    '''
+    shx = shp_path[:-3] + 'shx'
+    if os.path.getsize(shx) <= 100:
+        return np.zeros((0, 2), dtype='>i4')
+    return np.memmap(shx, dtype='>i4', mode='r', offset=100).reshape((-1, 2))
+
+def _shp_header(header, file_len, bbox):
+    '''
+    Rewrite file length (in bytes) and bounding box (left, lower, right,
+    upper) of a 100-byte .shp/.shx header. Z and M ranges are kept.
+    '''
+    return header[:24] + struct.pack('>i', file_len // 2) + header[28:36] + \
+            struct.pack('<4d', *bbox) + header[68:100]
+
+def _rec_bbox(buf, offset):
+    '''
+    Bounding box (left, lower, right, upper) of the shapefile record whose
+    content starts at `offset` in `buf`, None for null shapes
+    '''
+    shape_type = struct.unpack_from('<i', buf, offset)[0]
+    if shape_type == 0:
+        return None
+    if shape_type in (1, 11, 21):
+        x, y = struct.unpack_from('<2d', buf, offset + 4)
+        return (x, y, x, y)
+    return struct.unpack_from('<4d', buf, offset + 4)
+
+class _ShpWriter(object):
+    '''
+    Write raw shapefile records into a new .shp/.shx pair (and optionally
+    raw DBF records into its .dbf), renumbering them and keeping track of
+    length and bounding box to fill in the headers on close. Files are
+    opened in append mode when needed and can be released with suspend(),
+    so many writers can be alive with only a few open files.
+    ...
+
+    Arguments
+    ---------
+    shp_out     : str
+                  Path to the .shp to be created
+    header      : str
+                  100-byte header of the input .shp
+    dbf_header  : str
+                  [Optional] Raw header of the input .dbf (see
+                  dataIO._dbf_header). If None, no .dbf is written
+    '''
+    def __init__(self, shp_out, header, dbf_header=None):
+        self.paths = [shp_out, shp_out[:-3] + 'shx']
+        self.headers = [header, header]
+        if dbf_header is not None:
+            self.paths.append(shp_out[:-3] + 'dbf')
+            self.headers.append(dbf_header)
+        for path, head in zip(self.paths, self.headers):
+            f = open(path, 'wb')
+            f.write(head)
+            f.close()
+        self.files = None
+        self.pos = 100
+        self.n = 0
+        self.bbox = [np.inf, np.inf, -np.inf, -np.inf]
+
+    def _open(self):
+        if self.files is None:
+            self.files = [open(path, 'ab', 2**16) for path in self.paths]
+
+    def suspend(self):
+        'Close the files until next write'
+        if self.files is not None:
+            for f in self.files:
+                f.close()
+            self.files = None
+
+    def write(self, content, bbox, dbf_rec=None):
+        '''
+        Append the content bytes of a record (without its 8-byte header), its
+        bounding box (None for null shapes) and, if writing a .dbf, the raw
+        bytes of its DBF record
+        '''
+        self._open()
+        self.n += 1
+        self.files[0].write(struct.pack('>2i', self.n, len(content) // 2))
+        self.files[0].write(content)
+        self.files[1].write(struct.pack('>2i', self.pos // 2,
+            len(content) // 2))
+        if dbf_rec is not None:
+            self.files[2].write(dbf_rec)
+        self.pos += 8 + len(content)
+        if bbox is not None:
+            self.bbox = [min(self.bbox[0], bbox[0]), min(self.bbox[1], bbox[1]),
+                    max(self.bbox[2], bbox[2]), max(self.bbox[3], bbox[3])]
+
+    def close(self):
+        'Fill in the headers and close the files'
+        self.suspend()
+        bbox = self.bbox if self.bbox[0] <= self.bbox[2] else [0., 0., 0., 0.]
+        heads = [_shp_header(self.headers[0], self.pos, bbox),
+                _shp_header(self.headers[1], 100 + 8 * self.n, bbox)]
+        if len(self.paths) == 3:
+            heads.append(self.headers[2][:4] + struct.pack('<I', self.n) + \
+                    self.headers[2][8:])
+            f = open(self.paths[2], 'ab')
+            f.write('\x1a')
+            f.close()
+        for path, head in zip(self.paths, heads):
+            f = open(path, 'r+b')
+            f.write(head)
+            f.close()
+
+def _shp_subset(shp_in, shp_out, ids):
+    '''
+    Copy the records at positions `ids` of shp_in into a new .shp/.shx pair
+    in shp_out, byte by byte
+    '''
+    offsets, lengths = _read_shx(shp_in)
+    f = open(shp_in, 'rb')
+    header = f.read(100)
+    buf = mmap(f.fileno(), 0, access=ACCESS_READ)
+    out = _ShpWriter(shp_out, header)
+    for i in ids:
+        o = offsets[i] + 8
+        out.write(buf[o:o+lengths[i]], _rec_bbox(buf, o))
+    out.close()
+    buf.close()
+    f.close()
+    return shp_out
+
+def hilbert_sort_shp(shp_in, shp_out=None, id_col='ORIG_ID',
+        max_records=2**22, chunksize=2**16, tmp_dir=None, max_open=None):
+    '''
+    Reorder the records of a shapefile (.shp, .shx and .dbf) along a Hilbert
+    curve through the centres of their bounding boxes, so features close in
+    space are also close in the file
+
+    The sort runs in bounded memory: the Hilbert key of every record is
+    computed in chunks from the raw bounding boxes and spilled with its
+    position to a temporary file, the (key, position) pairs are then split
+    into temporary shards of consecutive key ranges of at most
+    `max_records` records each (as far as the keys allow), in as many passes
+    over the spilled pairs as needed to keep at most `max_open` shards open,
+    and every shard is sorted in memory and written out in turn. The .shx
+    and .dbf are
+    memory-mapped rather than loaded, so memory does not grow with the
+    number of records beyond `max_records`. Records are copied as raw
+    bytes (as in clip_shp).
+    ...
+
+    Arguments
+    =========
+    shp_in      : str
+                  Path to the shapefile to be sorted
+    shp_out     : str
+                  [Optional] Path to the shapefile to be created. If None,
+                  writes the file with the same name plus '_hilbert'
+                  appended.
+    id_col      : str
+                  Name of the column appended to the dbf with the position
+                  (starting at 0) of every record in shp_in. Defaults to
+                  'ORIG_ID'
+    max_records : int
+                  Max. number of records sorted in memory at once. Defaults
+                  to 2**22
+    chunksize   : int
+                  Number of records read at once. Defaults to 2**16
+    tmp_dir     : str
+                  [Optional] Folder for the temporary files. Defaults to the
+                  system's temporary folder
+    max_open    : int
+                  [Optional] Max. number of shard files open at once.
+                  Defaults to half the limit of open files of the process
+                  (see _max_open_files)
+    Returns
+    =======
+    shp_out     : str
+                  Path to the shapefile created
+    '''
+    if not shp_out:
+        shp_out = shp_in[:-4] + '_hilbert.shp'
+    max_open = max(1, max_open or _max_open_files())
+    dbh = _dbf_header(shp_in[:-3] + 'dbf')
+    if id_col in [f[0] for f in dbh['fields']]:
+        raise ValueError("Column %s already in %s" % (id_col, shp_in))
+    # The .shx is memory-mapped and read per chunk or shard, so no array
+    # over all the records is held in memory
+    shx = _shx_index(shp_in)
+    n = shx.shape[0]
+    id_spec = ('N', max(len(str(n)), 1), 0)
+    fields = dbh['fields'] + [(id_col[:10],) + id_spec]
+    recs = _dbf_records(shp_in[:-3] + 'dbf', dbh)
+    raw = recs.view((np.void, dbh['record_len']))
+    f = open(shp_in, 'rb')
+    header = f.read(100)
+    buf = mmap(f.fileno(), 0, access=ACCESS_READ)
+    m = np.frombuffer(buf, dtype=np.uint8)
+    pairs = np.dtype([('key', '<i8'), ('id', '<i8')])
+    fd, spill = tempfile.mkstemp(suffix='.keys', dir=tmp_dir)
+    os.close(fd)
+    shards = []
+    try:
+        # Keys of every record, spilled to disk, plus a histogram of their
+        # top bits to pick the key range of each shard
+        shift = max(2 * HILBERT_ORDER - 16, 0)
+        hist = np.zeros((1 << (2 * HILBERT_ORDER - shift)) + 1, dtype=np.int64)
+        bbox = struct.unpack('<4d', header[36:68])
+        out = open(spill, 'wb')
+        for start in range(0, n, chunksize):
+            o = shx[start:start+chunksize, 0].astype(np.int64) * 2 + 8
+            chunk = np.empty(o.shape[0], dtype=pairs)
+            chunk['key'] = _hilbert_keys(m, o, bbox)
+            chunk['id'] = np.arange(start, start + o.shape[0])
+            hist += np.bincount(chunk['key'] >> shift, minlength=hist.shape[0])
+            chunk.tofile(out)
+        out.close()
+        cut = np.cumsum(hist) // max(max_records, 1)
+        bin2shard = np.unique(cut, return_inverse=True)[1]
+        # Route the pairs into one shard per key range
+        for i in range(bin2shard.max() + 1):
+            fd, path = tempfile.mkstemp(suffix='.shard', dir=tmp_dir)
+            os.close(fd)
+            shards.append(path)
+        keys = np.memmap(spill, dtype=pairs, mode='r') if n else \
+                np.zeros(0, dtype=pairs)
+        for first in range(0, len(shards), max_open):
+            # One pass over the pairs per group of max_open shards
+            outs = [open(path, 'ab', 2**16) for path in \
+                    shards[first:first+max_open]]
+            try:
+                for start in range(0, n, chunksize):
+                    chunk = np.array(keys[start:start+chunksize])
+                    dest = bin2shard[chunk['key'] >> shift] - first
+                    mine = (dest >= 0) & (dest < len(outs))
+                    if not mine.all():
+                        chunk, dest = chunk[mine], dest[mine]
+                    order = np.argsort(dest, kind='mergesort')
+                    bounds = np.flatnonzero(np.diff(dest[order])) + 1
+                    for grp in np.split(order, bounds):
+                        if grp.size:
+                            chunk[grp].tofile(outs[dest[grp[0]]])
+            finally:
+                for o in outs:
+                    o.close()
+        del keys
+        # Sort each shard and write its records out
+        w = _ShpWriter(shp_out, header, _dbf_header_bytes(fields, n))
+        for path in shards:
+            shard = np.fromfile(path, dtype=pairs)
+            os.remove(path)
+            shard = shard[np.lexsort((shard['id'], shard['key']))]
+            ids = _dbf_format(shard['id'], id_spec)
+            recs = shx[shard['id']].astype(np.int64) * 2
+            for i, o, l, id_raw in itertools.izip(shard['id'],
+                    recs[:, 0] + 8, recs[:, 1], ids):
+                w.write(buf[o:o+l], _rec_bbox(buf, o),
+                        raw[i].tostring() + id_raw)
+            del recs
+        w.close()
+    finally:
+        for path in shards + [spill]:
+            if os.path.exists(path):
+                os.remove(path)
+        del m, shx
+        buf.close()
+        f.close()
+    if os.path.exists(shp_in[:-3] + 'prj'):
+        copyfile(shp_in[:-3] + 'prj', shp_out[:-3] + 'prj')
     return shp_out
 
+def _max_open_files():
+    '''
+    Shard files that can be open at once: half the soft limit of open files
+    of the process, keeping 16 descriptors for the files being read and
+    written alongside (64 if the limit is unknown)
+    '''
+    if resource is not None:
+        soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        if soft > 0:
+            return max(1, min(soft // 2, soft - 16))
+    return 64
+
+def _hilbert_keys(m, offsets, bbox, order=HILBERT_ORDER):
+    '''
+    Hilbert key of the centre of the bounding box of the shapefile records
+    whose content starts at `offsets` of `m` (a uint8 view of the .shp), on
+    a 2**order x 2**order grid over `bbox` (left, lower, right, upper).
+    Null shapes get key 4**order, after every other record.
+    '''
+    shape_type = m[offsets[:, None] + np.arange(4)].view('<i4').ravel()
+    # Points only have 16 bytes of coordinates and null shapes none: keep
+    # the (unused) bytes past them inside the file
+    idx = np.minimum(offsets[:, None] + np.arange(4, 36), m.shape[0] - 1)
+    d = m[idx].view('<f8')
+    pt = np.in1d(shape_type, (1, 11, 21))
+    x = np.where(pt, d[:, 0], (d[:, 0] + d[:, 2]) / 2.)
+    y = np.where(pt, d[:, 1], (d[:, 1] + d[:, 3]) / 2.)
+    side = 2**order
+    x = _grid_pos(x, bbox[0], bbox[2], side)
+    y = _grid_pos(y, bbox[1], bbox[3], side)
+    keys = _hilbert_d(x, y, order)
+    keys[shape_type == 0] = side * side
+    return keys
+
+def _hilbert_d(x, y, order=HILBERT_ORDER):
+    '''
+    Position along the Hilbert curve of integer positions x, y in
+    [0, 2**order) of a 2**order x 2**order grid (x and y are modified)
+    '''
+    side = 2**order
+    keys = np.zeros(x.shape[0], dtype=np.int64)
+    s = side // 2
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        keys += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant so the curve is continuous
+        flip = ~ry & rx
+        x[flip] = side - 1 - x[flip]
+        y[flip] = side - 1 - y[flip]
+        swap = ~ry
+        x[swap], y[swap] = y[swap], x[swap].copy()
+        s //= 2
+    return keys
+
+def _grid_pos(v, lo, hi, side):
+    'Integer position in [0, side) of values v on a grid from lo to hi'
+    span = hi - lo if hi > lo else 1.
+    pos = np.floor((v - lo) / span * side)
+    return np.clip(np.nan_to_num(pos), 0, side - 1).astype(np.int64)
+
+class GeometryArray(object):
+    '''
+    Geometries of a shapefile as flat NumPy arrays instead of one pysal
+    object per feature
+
+    Vertices of every part (ring of a polygon, piece of a line, point of a
+    multipoint) are stored one after another in a single coordinate buffer,
+    with offsets telling where every part and every geometry starts, in the
+    same layout as the polygon structure used by the point in polygon
+    functions. Point shapefiles with no null records are exposed zero-copy:
+    `coords` is a strided view straight over the memory-mapped .shp.
+    GeometryArray objects can be passed instead of paths to pip_xy_shp,
+    pip_shps (points and/or polygons) and dist_A2B.
+    ...
+
+    Arguments
+    ---------
+    shape_types : np.array
+                  Shapefile type of every geometry (0 for null shapes)
+    bbs         : np.array
+                  mx4 array with left, lower, right, upper of each geometry
+                  (NaN for null shapes). If None (points), taken from coords
+    coords      : np.array
+                  Nx2 array with the vertices of every part
+    part_off    : np.array
+                  Offsets of each part into coords (length P+1). If None, one
+                  vertex per part
+    geom_off    : np.array
+                  Offsets of each geometry into part_off (length m+1). If
+                  None, one part per geometry
+
+    Attributes
+    ----------
+    shape_types, coords : np.array
+                  As passed
+    bbs, part_off, geom_off : np.array
+                  As passed, built on first access if None
+    is_point    : boolean
+                  True if every geometry is a single point
+    '''
+    def __init__(self, shape_types, bbs, coords, part_off=None,
+            geom_off=None):
+        self.shape_types = shape_types
+        self.coords = coords
+        self._bbs = bbs
+        self._part_off = part_off
+        self._geom_off = geom_off
+
+    @classmethod
+    def from_shp(cls, shp_path, chunksize=2**16):
+        '''
+        Load the geometries of a .shp/.shx pair straight from their bytes,
+        `chunksize` records at a time. Points, multipoints, polylines and
+        polygons (with or without Z/M, which are dropped) are supported.
+        '''
+        offsets, lengths = _read_shx(shp_path)
+        n = offsets.shape[0]
+        f = open(shp_path, 'rb')
+        buf = mmap(f.fileno(), 0, access=ACCESS_READ)
+        f.close()
+        size = len(buf)
+        f8 = [np.frombuffer(buf, '<f8', (size - k) // 8, k) for k in range(8)]
+        i4 = [np.frombuffer(buf, '<i4', (size - k) // 4, k) for k in range(4)]
+        o = offsets + 8
+        types = _gather(i4, o, np.ones(n, dtype=np.int64))
+        pt = np.in1d(types, (1, 11, 21))
+        if n and pt.all() and (lengths == lengths[0]).all() and \
+                (np.diff(offsets) == lengths[0] + 8).all():
+            # Fixed-size records: view x, y of every point in place
+            coords = np.ndarray((n, 2), '<f8', buf, offsets[0] + 12,
+                    (lengths[0] + 8, 8))
+            return cls(types, None, coords)
+        multi = np.in1d(types, (8, 18, 28))
+        poly = np.in1d(types, (3, 5, 13, 15, 23, 25))
+        bad = ~(pt | multi | poly | (types == 0))
+        if bad.any():
+            raise ValueError("Shape type %i not supported" % types[bad][0])
+        one = np.ones(n, dtype=np.int64)
+        n_pts = np.zeros(n, dtype=np.int64)
+        n_pts[pt] = 1
+        n_pts[multi] = _gather(i4, o[multi] + 36, one[multi])
+        n_pts[poly] = _gather(i4, o[poly] + 40, one[poly])
+        n_parts = np.zeros(n, dtype=np.int64)
+        n_parts[pt] = 1
+        n_parts[multi] = n_pts[multi] > 0
+        n_parts[poly] = _gather(i4, o[poly] + 36, one[poly])
+        pts_at = o + 4
+        pts_at[multi] += 36
+        pts_at[poly] += 40 + 4 * n_parts[poly]
+        bbs = np.empty((n, 4))
+        bbs[:] = np.nan
+        box = multi | poly
+        bbs[box] = _gather(f8, o[box] + 4, one[box] * 4).reshape((-1, 4))
+        vtx_off = np.concatenate(([0], np.cumsum(n_pts)))
+        coords = np.empty((vtx_off[-1], 2))
+        for start in range(0, n, chunksize):
+            end = min(start + chunksize, n)
+            coords[vtx_off[start]:vtx_off[end]] = _gather(f8,
+                    pts_at[start:end], n_pts[start:end] * 2).reshape((-1, 2))
+        bbs[pt] = np.hstack((coords[vtx_off[:-1][pt]],) * 2)
+        geom_off = np.concatenate(([0], np.cumsum(n_parts)))
+        part_off = np.zeros(geom_off[-1] + 1, dtype=np.int64)
+        part_off[_ranges(geom_off[:-1][poly], n_parts[poly])] = \
+                _gather(i4, o[poly] + 44, n_parts[poly])
+        part_off[:-1] += np.repeat(vtx_off[:-1], n_parts)
+        part_off[-1] = vtx_off[-1]
+        del f8, i4
+        buf.close()
+        return cls(types, bbs, coords, part_off, geom_off)
+
+    def __len__(self):
+        return self.shape_types.shape[0]
+
+    @property
+    def is_point(self):
+        return self._part_off is None or (len(self) == self.coords.shape[0]
+                and np.in1d(self.shape_types, (1, 11, 21)).all())
+
+    @property
+    def bbs(self):
+        if self._bbs is None:
+            self._bbs = np.hstack((self.coords, self.coords))
+        return self._bbs
+
+    @property
+    def part_off(self):
+        if self._part_off is None:
+            self._part_off = np.arange(self.coords.shape[0] + 1)
+        return self._part_off
+
+    @property
+    def geom_off(self):
+        if self._geom_off is None:
+            self._geom_off = np.arange(len(self) + 1)
+        return self._geom_off
+
+    def centers(self):
+        '''
+        nx2 array with the points of a point layer, the centres of the
+        bounding boxes of the geometries otherwise
+        '''
+        if self.is_point:
+            return np.asarray(self.coords, dtype=float)
+        bbs = self.bbs
+        return np.column_stack(((bbs[:, 0] + bbs[:, 2]) / 2.,
+            (bbs[:, 1] + bbs[:, 3]) / 2.))
+
+    def take(self, ids):
+        'Subset with the geometries at positions ids, as a new GeometryArray'
+        ids = np.asarray(ids, dtype=np.int64)
+        if self._part_off is None:
+            return GeometryArray(self.shape_types[ids], None,
+                    np.array(self.coords[ids]))
+        g0, g1 = self.geom_off[ids], self.geom_off[ids + 1]
+        parts = _ranges(g0, g1 - g0)
+        v0, v1 = self.part_off[parts], self.part_off[parts + 1]
+        part_off = np.concatenate(([0], np.cumsum(v1 - v0)))
+        geom_off = np.concatenate(([0], np.cumsum(g1 - g0)))
+        return GeometryArray(self.shape_types[ids], self.bbs[ids],
+                self.coords[_ranges(v0, v1 - v0)], part_off, geom_off)
+
+    def polys(self):
+        'Polygons (with their R-tree index) as used by the pip functions'
+        bbs = self.bbs
+        null = np.isnan(bbs).any(axis=1)
+        if null.any():
+            # Park null shapes on a corner of the layer, out of the way
+            bbs = bbs.copy()
+            bbs[null] = np.nanmin(bbs[:, :2], axis=0).tolist() * 2 if \
+                    (~null).any() else 0.
+        return _PolyArrays(bbs, self.coords, self.part_off, self.geom_off,
+                *_bbox_tree(bbs))
+
+def _gather(views, starts, counts):
+    '''
+    Read `counts` consecutive values starting at every byte offset in
+    `starts` of a buffer, given views of it (one per byte alignment) with
+    the dtype to read. Returns all the values concatenated.
+    '''
+    size = views[0].itemsize
+    out = np.empty(counts.sum(), dtype=views[0].dtype)
+    dst = np.cumsum(counts) - counts
+    align = starts % size
+    for k in np.unique(align):
+        sel = np.flatnonzero(align == k)
+        out[_ranges(dst[sel], counts[sel])] = \
+                views[k][_ranges((starts[sel] - k) // size, counts[sel])]
+    return out
+
+def _ranges(starts, lens):
+    'Concatenation of arange(s, s + l) for every start s and length l'
+    idx = np.arange(lens.sum(), dtype=np.int64)
+    return idx + np.repeat(starts - np.cumsum(lens) + lens, lens)
+
 def pip_shps_multi(pt_shp, poly_shp, polyID_col=None, out_shp=None,
-        empty='empty'):
+        empty='empty', pool=None, cache=False):
     '''
     Point in polygon operation taking as input a point and a polygon
     shapefiles (running on multicore)
@@ -88,6 +762,13 @@ def pip_shps_multi(pt_shp, poly_shp, polyID_col=None, out_shp=None,
     empty           : str
                       String to insert if the point is not contained in any
                       polygon. Defaults to 'empty'
+    pool            : multiprocessing.Pool
+                      Pool created with pip_pool to reuse across calls. If
+                      None (default), a pool is created for this call and shut
+                      down at the end
+    cache           : boolean/str
+                      Reuse an on-disk copy of the polygons (see _load_polys).
+                      Defaults to False
 
     Returns
     =======
@@ -96,39 +777,26 @@ def pip_shps_multi(pt_shp, poly_shp, polyID_col=None, out_shp=None,
                       points are located
     '''
     t0 = time.time()
-    polys = ps.open(poly_shp)
-    if polyID_col:
-        polyIDs = ps.open(poly_shp[:-3]+'dbf').by_col(polyID_col)
-    pl = ps.cg.PolygonLocator(polys)
+    xy = np.concatenate(list(_iter_pts(pt_shp, PIP_CHUNK_SIZE)) or \
+            [np.zeros((0, 2))])
     t1 = time.time()
-    print '\t', t1-t0, ' secs to build rtree'
-
-    pts = ps.open(pt_shp)
-    lpts = list(pts)
-    parss = [(pt, pl) for pt in lpts]
-    cores = mp.cpu_count()
-    pool = mp.Pool(cores)
-    correspondences = pool.map(_poly4pt, parss)
+    print '\t', t1-t0, ' secs to read points'
+
+    pip = _pip_multi(xy, poly_shp, pool=pool, cache=cache)
     t2 = time.time()
     print '\t', t2-t1, ' secs to get correspondences'
-    if polyID_col:
-        correspondences_names= []
-        for i in correspondences:
-            try:
-                correspondences_names.append(polyIDs[int(i)])
-            except:
-                correspondences_names.append(empty)
-        correspondences = correspondences_names
-    pts.close()
-    polys.close()
+    correspondences = _pip2ids(pip, poly_shp, polyID_col, empty)
     t3 = time.time()
     print '\t', t3-t2, ' secs to convert correspondences'
     if out_shp:
-        _writeShp()
+        _write_pip_shp(pt_shp, out_shp, correspondences, polyID_col)
+        t4 = time.time()
+        print '\t', t4-t3, ' seconds to write shapefile'
+        print 'Shapefile written to %s'%out_shp
     return correspondences
 
 def pip_xy_shp_multi(xy, poly_shp, polyID_col=None, out_shp=None,
-        empty=None):
+        empty=None, pool=None, cache=False):
     '''
     Point in polygon operation taking as input a points array and a polygon
     shapefile (running on multicore)
@@ -150,6 +818,13 @@ def pip_xy_shp_multi(xy, poly_shp, polyID_col=None, out_shp=None,
     empty           : str
                       String to insert if the point is not contained in any
                       polygon. Defaults to None
+    pool            : multiprocessing.Pool
+                      Pool created with pip_pool to reuse across calls. If
+                      None (default), a pool is created for this call and shut
+                      down at the end
+    cache           : boolean/str
+                      Reuse an on-disk copy of the polygons (see _load_polys).
+                      Defaults to False
 
     Returns
     =======
@@ -157,100 +832,1053 @@ def pip_xy_shp_multi(xy, poly_shp, polyID_col=None, out_shp=None,
                       List of length len(xy) with the polygon ID where the
                       points are located
     '''
-    t0 = time.time()
-    polys = ps.open(poly_shp)
-    if polyID_col:
-        polyIDs = ps.open(poly_shp[:-3]+'dbf').by_col(polyID_col)
-    pl = ps.cg.PolygonLocator(polys)
     t1 = time.time()
-    print '\t', t1-t0, ' secs to build rtree'
-
-    parss = zip(xy, [pl]*xy.shape[0])
-    cores = mp.cpu_count()
-    pool = mp.Pool(cores)
-    correspondences = pool.map(_poly4xy, parss)
+    pip = _pip_multi(np.asarray(xy, dtype=float), poly_shp, pool=pool,
+            cache=cache)
     t2 = time.time()
     print '\t', t2-t1, ' secs to get correspondences'
-    if polyID_col:
-        correspondences_names= []
-        for i in correspondences:
-            try:
-                correspondences_names.append(polyIDs[int(i)])
-            except:
-                correspondences_names.append(empty)
-        correspondences = correspondences_names
-    polys.close()
+    correspondences = _pip2ids(pip, poly_shp, polyID_col, empty)
     t3 = time.time()
     print '\t', t3-t2, ' secs to convert correspondences'
     if out_shp:
-        _writeShp()
+        _write_pip_shp(xy, out_shp, correspondences, polyID_col)
+        t4 = time.time()
+        print '\t', t4-t3, ' seconds to write shapefile'
+        print 'Shapefile written to %s'%out_shp
     return correspondences
 
-def _poly4xy(pars):
-    'Return the poly where pt is'
-    pt, pl = pars
-    x, y = pt
-    candidates = pl.contains_point(pt)
-    for cand in candidates:
-        if cand.contains_point(pt)==1:
-            return cand.id-1 #one-offset
-    return 'out'
-
-def _poly4pt(pars):
-    pt, pl = pars
-    'Return the poly where pt is'
-    x,y = pt
-    candidates = pl.contains_point(pt)
-    for cand in candidates:
-        if cand.contains_point(pt)==1:
-            return cand.id-1 #one-offset
-    return 'out'
-
-def _writeShp():
-    oShp = ps.open(out_shp, 'w')
-    shp = ps.open(pt_shp)
-    oDbf = ps.open(out_shp[:-3]+'dbf', 'w')
-    dbf = ps.open(pt_shp[:-3]+'dbf')
-    oDbf.header = dbf.header
-    col_name = 'in_poly'
-    col_spec = ('C', 14, 0)
-    if polyID_col:
-        col_name = polyID_col
-        #db = ps.open(poly_shp[:-3]+'dbf')
-        #col_spec = db.field_spec[db.header.index(polyID_col)]
-    oDbf.header.append(col_name)
-    oDbf.field_spec = dbf.field_spec
-    oDbf.field_spec.append(col_spec)
-    for poly, rec, i in zip(shp, dbf, correspondences):
-        oShp.write(poly)
-        rec.append(i)
-        oDbf.write(rec)
-    shp.close()
-    oShp.close()
-    dbf.close()
-    oDbf.close()
-    prj = open(pt_shp[:-3]+'prj').read()
-    oPrj = open(out_shp[:-3]+'prj', 'w')
-    oPrj.write(prj); oPrj.close()
-    t4 = time.time()
-    print '\t', t4-t3, ' seconds to write shapefile'
-    print 'Shapefile written to %s'%out_shp
-
-def pip_shps(pt_shp, poly_shp, polyID_col=None, out_shp=None, empty='empty'):
+def pip_xy_shp(xy, poly_shp, cache=False):
+    '''
+    Point in polygon operation taking as input a points array and a polygon
+    shapefile (vectorized, single core)
+
+    Points are processed in bulk, in chunks of PIP_CHUNK_SIZE: candidate
+    polygons are looked up in an R-tree over their bounding boxes and
+    containment is evaluated with ray casting over arrays of points, so
+    there is no Python call per point.
+    ...
+
+    Arguments
+    =========
+    xy              : np.array
+                      nx2 array with xy coordinates
+    poly_shp        : str/GeometryArray
+                      Path to polygon shapefile, or its geometries already
+                      loaded
+    cache           : boolean/str
+                      Reuse an on-disk copy of the polygons (see _load_polys).
+                      Defaults to False
+
+    Returns
+    =======
+    correspondences : np.array
+                      Integer array of length len(xy) with the position
+                      (zero-offset) in poly_shp of the polygon where each point
+                      is located, -1 if it is not contained in any polygon
+    '''
+    t0 = time.time()
+    pa = _load_polys(poly_shp, cache)
+    t1 = time.time()
+    print '\t', t1-t0, ' secs to load polygons'
+    # Points go in chunks so candidate pairs of only one are held at once;
+    # slab indices of large polygons are shared across chunks
+    slabs = {}
+    correspondences = np.concatenate([_pip_arrays(chunk, pa, slabs) for \
+            chunk in _iter_pts(np.asarray(xy, dtype=float), PIP_CHUNK_SIZE)]
+            or [np.zeros(0, dtype=int)])
+    t2 = time.time()
+    print '\t', t2-t1, ' secs to get correspondences'
+    return correspondences
+
+def _load_polys(poly_shp, cache=False):
+    '''
+    Load a polygon shapefile as a _PolyArrays structure, optionally through a
+    persistent on-disk cache
+    ...
+
+    Arguments
+    ---------
+    poly_shp    : str/GeometryArray
+                  Path to polygon shapefile, or its geometries already loaded
+                  (the cache is not used then)
+    cache       : boolean/str
+                  If True, the arrays are cached in a folder next to poly_shp
+                  (same name with extension .pipcache); if a string, in a
+                  subfolder of that directory keyed by the absolute path of
+                  poly_shp. Later calls memory-map the cached arrays instead
+                  of parsing the shapefile. Caches of an older version of
+                  poly_shp (different size or mtime) are evicted and rebuilt.
+                  Defaults to False (no cache)
+
+    Returns
+    -------
+    pa          : _PolyArrays
+                  Bounding boxes, vertices and ring/polygon offsets of poly_shp
+    '''
+    if isinstance(poly_shp, GeometryArray):
+        return poly_shp.polys()
+    if cache:
+        if cache is True:
+            path = poly_shp[:-3] + 'pipcache'
+        else:
+            if not os.path.isdir(cache):
+                os.makedirs(cache)
+            key = hashlib.md5(os.path.abspath(poly_shp)).hexdigest()
+            path = os.path.join(cache, key)
+        arrays = _cache_load(path, poly_shp)
+        if arrays is not None and set(arrays) == set(_PolyArrays._fields):
+            return _PolyArrays(**arrays)
+    pa = GeometryArray.from_shp(poly_shp).polys()
+    if cache:
+        _cache_save(path, pa._asdict(), poly_shp)
+    return pa
+
+def _bbox_tree(bbs, node=None):
+    '''
+    Build a packed R-tree over a set of bounding boxes
+
+    Boxes are sorted along a Hilbert curve through their centres and grouped
+    in runs of `node` consecutive boxes, whose bounding boxes are grouped in
+    turn up to a single root. Every node covers a compact area however
+    skewed the sizes of the boxes are, and the children of a node are always
+    consecutive in the level below, so the tree is stored as flat arrays.
+    ...
+
+    Arguments
+    ---------
+    bbs         : np.array
+                  mx4 array with left, lower, right, upper of each box
+    node        : int
+                  Max. number of children of each node. Defaults to
+                  PIP_TREE_NODE
+
+    Returns
+    -------
+    tree_bbs    : np.array
+                  Bounding boxes level by level: the boxes themselves in
+                  Hilbert order (level 0), then the nodes of every level up
+                  to the root
+    tree_off    : np.array
+                  Offsets of each level into tree_bbs (length levels+1).
+                  Children of node j of a level are the entries j*node to
+                  (j+1)*node-1 of the level below
+    tree_items  : np.array
+                  Positions of the boxes in Hilbert order
+    '''
+    node = node or PIP_TREE_NODE
+    if not bbs.shape[0]:
+        return np.zeros((0, 4)), np.zeros(2, dtype=int), np.zeros(0, dtype=int)
+    x0, y0 = bbs[:, :2].min(axis=0)
+    x1, y1 = bbs[:, 2:].max(axis=0)
+    side = 2**HILBERT_ORDER
+    x = _grid_pos((bbs[:, 0] + bbs[:, 2]) / 2., x0, x1, side)
+    y = _grid_pos((bbs[:, 1] + bbs[:, 3]) / 2., y0, y1, side)
+    tree_items = np.argsort(_hilbert_d(x, y), kind='mergesort')
+    level = bbs[tree_items]
+    levels = [level]
+    while level.shape[0] > 1:
+        starts = np.arange(0, level.shape[0], node)
+        level = np.hstack((np.minimum.reduceat(level[:, :2], starts),
+            np.maximum.reduceat(level[:, 2:], starts)))
+        levels.append(level)
+    tree_off = np.concatenate(([0], np.cumsum([l.shape[0] for l in levels])))
+    return np.concatenate(levels), tree_off, tree_items
+
+def _pip_candidates(xy, pa, block=None):
+    '''
+    Candidate (point, polygon) pairs for an array of points: polygons whose
+    bounding box contains each point, found walking down the R-tree of pa
+    (see _bbox_tree). Pairs are yielded in blocks of about `block` (defaults
+    to PIP_PAIRS_SIZE) pairs at most, each as two arrays sorted by polygon;
+    the pairs of a point may be spread over several blocks.
+    '''
+    block = block or PIP_PAIRS_SIZE
+    node = PIP_TREE_NODE
+    tb, off = pa.tree_bbs, pa.tree_off
+    top = off.shape[0] - 2
+    if not pa.tree_items.size:
+        return
+    root = tb[off[top]]
+    pts = np.flatnonzero((xy[:, 0] >= root[0]) & (xy[:, 0] <= root[2]) & \
+            (xy[:, 1] >= root[1]) & (xy[:, 1] <= root[3]))
+    # Depth first over (level, points, nodes) frontiers whose points are all
+    # inside the box of their node
+    stack = [(top, pts, np.zeros(pts.shape[0], dtype=int))]
+    children = np.arange(node)
+    out, size = [], 0
+    while stack:
+        lev, pt, nd = stack.pop()
+        if pt.shape[0] * node > block and pt.shape[0] > 1:
+            half = pt.shape[0] // 2
+            stack.append((lev, pt[half:], nd[half:]))
+            stack.append((lev, pt[:half], nd[:half]))
+            continue
+        # Every point against every child of its node (n x node), the last
+        # node of a level may have fewer
+        child = nd[:, None] * node + children
+        last = off[lev] - off[lev-1] - 1
+        bb = tb[off[lev-1] + np.minimum(child, last)]
+        px, py = xy[pt, 0][:, None], xy[pt, 1][:, None]
+        keep = (child <= last) & (px >= bb[..., 0]) & (px <= bb[..., 2]) & \
+                (py >= bb[..., 1]) & (py <= bb[..., 3])
+        row, col = np.nonzero(keep)
+        pt, child = pt[row], child[row, col]
+        if lev > 1:
+            stack.append((lev - 1, pt, child))
+            continue
+        out.append((pt, pa.tree_items[child]))
+        size += pt.shape[0]
+        if size >= block or not stack:
+            pt = np.concatenate([o[0] for o in out])
+            poly = np.concatenate([o[1] for o in out])
+            out, size = [], 0
+            if poly.size:
+                order = np.argsort(poly, kind='mergesort')
+                yield pt[order], poly[order]
+
+def _poly_edges(pa, i):
+    '''
+    Non-horizontal edges of the i-th polygon in pa as four arrays (x1, y1, x2,
+    y2). Rings are closed implicitly, so both open and closed rings work.
+    '''
+    r0, r1 = pa.geom_off[i], pa.geom_off[i+1]
+    v0 = pa.ring_off[r0]
+    v = pa.coords[v0:pa.ring_off[r1]]
+    nxt = np.arange(1, v.shape[0] + 1)
+    nxt[pa.ring_off[r0+1:r1+1] - v0 - 1] = pa.ring_off[r0:r1] - v0
+    w = v[nxt]
+    keep = v[:, 1] != w[:, 1]
+    return v[keep, 0], v[keep, 1], w[keep, 0], w[keep, 1]
+
+def _ray_cast(pts, edges, block=None):
+    '''
+    Even-odd ray casting of pts (kx2 array) against a polygon given by its
+    edges (as returned by _poly_edges). Point-edge pairs are evaluated in
+    blocks of at most `block` (defaults to PIP_BLOCK_SIZE) elements.
+
+    Returns a boolean array of length k, True for points inside
+    '''
+    x1, y1, x2, y2 = edges
+    inside = np.zeros(pts.shape[0], dtype=bool)
+    if not x1.size:
+        return inside
+    slope = (x2 - x1) / (y2 - y1)
+    step = max(1, (block or PIP_BLOCK_SIZE) // x1.size)
+    for s in range(0, pts.shape[0], step):
+        px = pts[s:s+step, 0][:, None]
+        py = pts[s:s+step, 1][:, None]
+        cross = ((y1 > py) != (y2 > py)) & (px < x1 + (py - y1) * slope)
+        inside[s:s+step] = cross.sum(axis=1) % 2 == 1
+    return inside
+
+def _edge_slabs(edges):
+    '''
+    Index the edges of a polygon (as returned by _poly_edges) by horizontal
+    slabs: the y extent of the polygon is split into about sqrt(m) slabs
+    of equal height and every edge is registered in all the slabs its y
+    range overlaps. A point can only cross edges of its own slab, so ray
+    casting only needs to visit those.
+
+    Returns a tuple with the lower y and height of the slabs, their number,
+    offsets of each slab into the edge list (CSR), the edge list and the
+    edges themselves
+    '''
+    x1, y1, x2, y2 = edges
+    m = x1.size
+    k = max(1, int(np.sqrt(m)))
+    lo, hi = np.minimum(y1, y2), np.maximum(y1, y2)
+    y0 = lo.min()
+    h = (hi.max() - y0) / k or 1.
+    b0, b1 = _slab_of(lo, y0, h, k), _slab_of(hi, y0, h, k)
+    cnt = b1 - b0 + 1
+    edge = np.repeat(np.arange(m), cnt)
+    slab = np.repeat(b0, cnt) + np.arange(cnt.sum()) - \
+            np.repeat(np.cumsum(cnt) - cnt, cnt)
+    items = edge[np.argsort(slab, kind='mergesort')]
+    off = np.concatenate(([0], np.cumsum(np.bincount(slab, minlength=k))))
+    return y0, h, k, off, items, edges
+
+def _slab_of(y, y0, h, k):
+    'Slab (of an _edge_slabs index) where every y falls, clipped'
+    return np.clip(np.floor((y - y0) / h), 0, k - 1).astype(int)
+
+def _ray_cast_slabs(pts, slabs):
+    '''
+    Same as _ray_cast, with the edges indexed by _edge_slabs: points are
+    grouped by slab and only tested against the edges of theirs. Results are
+    identical, as edges outside a point's slab can never be crossed by it.
+    '''
+    y0, h, k, off, items, (x1, y1, x2, y2) = slabs
+    inside = np.zeros(pts.shape[0], dtype=bool)
+    slab = _slab_of(pts[:, 1], y0, h, k)
+    order = np.argsort(slab, kind='mergesort')
+    bounds = np.flatnonzero(np.diff(slab[order])) + 1
+    for grp in np.split(order, bounds):
+        if not grp.size:
+            continue
+        e = items[off[slab[grp[0]]]:off[slab[grp[0]] + 1]]
+        inside[grp] = _ray_cast(pts[grp], (x1[e], y1[e], x2[e], y2[e]))
+    return inside
+
+def _pip_arrays(xy, pa, slabs=None):
+    '''
+    Vectorized point in polygon of an array of points against a _PolyArrays
+    structure. If a point falls in several polygons, the first one is
+    returned. Polygons with more than PIP_SLAB_EDGES edges are tested through
+    a slab index of their edges (see _edge_slabs).
+    ...
+
+    Arguments
+    ---------
+    xy          : np.array
+                  nx2 array with xy coordinates
+    pa          : _PolyArrays
+                  Polygons to check against
+    slabs       : dict
+                  [Optional] Slab indices of the large polygons of pa, keyed
+                  by position. Indices missing are built and added to it, so
+                  passing the same dict to later calls reuses them
+
+    Returns
+    -------
+    pip         : np.array
+                  Integer array of length n with the position of the polygon
+                  where each point is, -1 if outside every polygon
+    '''
+    # Points not found yet hold m, so the first polygon of a point is kept
+    # whatever the order its candidate pairs come in
+    m = pa.bbs.shape[0]
+    pip = np.repeat(m, xy.shape[0])
+    for pt, poly in _pip_candidates(xy, pa):
+        bounds = np.flatnonzero(np.diff(poly)) + 1
+        for s, e in zip(np.concatenate(([0], bounds)),
+                np.concatenate((bounds, [poly.size]))):
+            i = poly[s]
+            cand = pt[s:e]
+            cand = cand[pip[cand] > i]
+            if not cand.size:
+                continue
+            if slabs is not None and i in slabs:
+                inside = _ray_cast_slabs(xy[cand], slabs[i])
+            else:
+                edges = _poly_edges(pa, i)
+                if edges[0].size > PIP_SLAB_EDGES and cand.size > 1:
+                    index = _edge_slabs(edges)
+                    if slabs is not None:
+                        slabs[i] = index
+                    inside = _ray_cast_slabs(xy[cand], index)
+                else:
+                    inside = _ray_cast(xy[cand], edges)
+            pip[cand[inside]] = i
+    pip[pip == m] = -1
+    return pip
+
+class PolygonIndex(object):
+    '''
+    Point in polygon index over a polygon shapefile, built once and queried
+    as many times as needed (e.g. by a long-running service)
+
+    Polygons, their R-tree index and the slab index of their large polygons
+    (see _edge_slabs) are all built on construction and never modified
+    afterwards, so query() can be called from several threads at once.
+    ...
+
+    Arguments
+    ---------
+    poly_shp    : str/GeometryArray
+                  Path to polygon shapefile, or its geometries already loaded
+    polyID_col  : str
+                  [Optional] Name of the column in the polygon shapefile to
+                  be returned as ID (poly_shp has to be a path). If None
+                  (default), query returns polygon positions
+    empty       : object
+                  Value returned for points outside every polygon when
+                  polyID_col or ids are passed. Defaults to None
+    cache       : boolean/str
+                  Reuse an on-disk copy of the polygons (see _load_polys).
+                  Defaults to False
+    ids         : sequence
+                  [Optional] ID of every polygon, in order, to be returned
+                  instead of positions. Alternative to polyID_col, e.g. when
+                  poly_shp is a GeometryArray
+
+    Attributes
+    ----------
+    queries     : int
+                  Number of calls to query served
+    points      : int
+                  Total number of points queried
+    time        : float
+                  Total seconds spent in query
+    '''
+    def __init__(self, poly_shp, polyID_col=None, empty=None, cache=False,
+            ids=None):
+        if polyID_col and ids is not None:
+            raise ValueError("Pass either polyID_col or ids, not both")
+        _check_polyID(poly_shp, polyID_col)
+        self.pa = _load_polys(poly_shp, cache)
+        self.ids = None
+        if polyID_col:
+            self.ids = _pip_ids_table(poly_shp, polyID_col, empty)
+        elif ids is not None:
+            ids = list(ids)
+            if len(ids) != len(self):
+                raise ValueError("%i ids passed for %i polygons" % \
+                        (len(ids), len(self)))
+            self.ids = np.array(ids + [empty], dtype=object)
+        pa = self.pa
+        nv = pa.ring_off[pa.geom_off[1:]] - pa.ring_off[pa.geom_off[:-1]]
+        self.slabs = {}
+        for i in np.flatnonzero(nv > PIP_SLAB_EDGES):
+            self.slabs[i] = _edge_slabs(_poly_edges(pa, i))
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.points = 0
+        self.time = 0.
+
+    def __len__(self):
+        return self.pa.bbs.shape[0]
+
+    def query(self, xy):
+        '''
+        Polygon where each of a batch of points falls
+        ...
+
+        Arguments
+        ---------
+        xy      : np.array
+                  nx2 array with xy coordinates
+
+        Returns
+        -------
+        pip     : np.array
+                  Array of length n with the ID of the polygon of every
+                  point (`empty` if outside every polygon) if polyID_col or
+                  ids were passed, its position (-1 if outside) otherwise.
+                  If a point falls in several polygons, the first one is
+                  returned
+        '''
+        t0 = time.time()
+        xy = np.asarray(xy, dtype=float).reshape((-1, 2))
+        pip = _pip_arrays(xy, self.pa, self.slabs)
+        if self.ids is not None:
+            pip = self.ids[pip]
+        with self._lock:
+            self.queries += 1
+            self.points += xy.shape[0]
+            self.time += time.time() - t0
+        return pip
+
+    def stats(self):
+        'Counters of the index as a dict (queries, points, time)'
+        with self._lock:
+            return {'queries': self.queries, 'points': self.points,
+                    'time': self.time}
+
+def pip_pool(poly_shp=None, cores=None, cache=False):
+    '''
+    Process pool for the multicore point in polygon functions
+
+    Workers keep the polygons they use in memory, so a pool can be passed to
+    pip_shps_multi and pip_xy_shp_multi in as many calls as needed and only
+    the points travel to the workers. If poly_shp is passed, its polygons are
+    loaded before the workers start (so they are inherited on fork or sent
+    once to each worker at start up) and kept for the life of the pool; any
+    other polygon shapefile is loaded by each worker the first time it gets
+    points for it, keeping the PIP_POOL_LAYERS used last. Polygons are
+    loaded again if their file changes on disk, and none outlive the pool in
+    the calling process. Shut the pool down explicitly with pool.close() and
+    pool.join() when done.
+    ...
+
+    Arguments
+    ---------
+    poly_shp    : str/GeometryArray
+                  [Optional] Path to polygon shapefile to preload, or its
+                  geometries already loaded (the pool can then only be used
+                  with this same GeometryArray)
+    cores       : int
+                  Number of worker processes. Defaults to all the cores
+                  available
+    cache       : boolean/str
+                  Reuse an on-disk copy of poly_shp (see _load_polys).
+                  Defaults to False
+
+    Returns
+    -------
+    pool        : multiprocessing.Pool
+                  Pool with the polygons loaded in every worker
+    '''
+    key = polys = None
+    if poly_shp is not None:
+        key = _polys_key(poly_shp, cache)
+        polys = _load_polys(poly_shp, cache)
+    # The loaded polygons travel as initializer arguments (inherited on fork)
+    # and are only kept in the workers, not in this process
+    return mp.Pool(cores or mp.cpu_count(), _pip_init, (key, polys))
+
+# Polygons preloaded in a pip_pool worker, kept for the life of the pool, and
+# polygons loaded on demand, least recently used first. Both are keyed by
+# _polys_key and hold (polygons, slab indices) pairs for _pip_arrays
+_worker_preload = {}
+_worker_polys = OrderedDict()
+
+def _polys_key(poly_shp, cache):
+    '''
+    Key of poly_shp in the polygons of a pip_pool worker: signature of the
+    file (path, size and mtime) and cache, so a file replaced on disk is
+    loaded again. GeometryArrays are keyed by identity, as preloaded ones are
+    never sent to the workers again.
+    '''
+    if isinstance(poly_shp, GeometryArray):
+        return ('GeometryArray', id(poly_shp))
+    sig = _file_sig(poly_shp)
+    return (sig['path'], sig['size'], sig['mtime'], cache)
+
+def _worker_polys_get(key, poly_shp, cache):
+    '''
+    Return the (polygons, slab indices) of poly_shp in a pip_pool worker,
+    loading them only the first time and again whenever the file changes
+    '''
+    if key in _worker_preload:
+        return _worker_preload[key]
+    if key[0] == 'GeometryArray':
+        raise ValueError("GeometryArray polygons have to be preloaded "
+                "with pip_pool(poly_shp)")
+    if key in _worker_polys:
+        _worker_polys[key] = _worker_polys.pop(key)
+        return _worker_polys[key]
+    # Drop the polygons of older versions of the same file and then the
+    # least recently used ones
+    for old in [k for k in _worker_polys if k[0] == key[0]]:
+        del _worker_polys[old]
+    while len(_worker_polys) >= PIP_POOL_LAYERS:
+        _worker_polys.popitem(last=False)
+    _worker_polys[key] = (_load_polys(poly_shp, cache), {})
+    return _worker_polys[key]
+
+def _pip_init(key, polys):
+    'Initializer of pip_pool workers'
+    if key is not None:
+        _worker_preload[key] = (polys, {})
+
+def _pip_chunk(pars):
+    '''
+    Point in polygon of a chunk of points inside a pip_pool worker. pars are
+    the points, the key of the polygons (see _polys_key) and, to load them
+    if needed, the path to the polygon shapefile and cache
+    '''
+    xy, key, poly_shp, cache = pars
+    pa, slabs = _worker_polys_get(key, poly_shp, cache)
+    return _pip_arrays(xy, pa, slabs)
+
+def _pip_tasks(chunks, poly_shp, cache):
+    '''
+    Arguments of _pip_chunk for every chunk of points against poly_shp.
+    GeometryArrays are replaced by their key, so they are not sent along
+    '''
+    key = _polys_key(poly_shp, cache)
+    if isinstance(poly_shp, GeometryArray):
+        poly_shp = None
+    for xy in chunks:
+        yield xy, key, poly_shp, cache
+
+def _pip_multi(xy, poly_shp, pool=None, cache=False):
+    '''
+    Vectorized point in polygon of xy against poly_shp spread over the workers
+    of a pool in contiguous chunks of PIP_CHUNK_SIZE points. If pool is None,
+    one is created and shut down at the end.
+    '''
+    own = pool is None
+    if own:
+        pool = pip_pool(poly_shp, cache=cache)
+    try:
+        chunks = [xy[i:i+PIP_CHUNK_SIZE] for i in \
+                range(0, xy.shape[0], PIP_CHUNK_SIZE)]
+        pip = pool.map(_pip_chunk, list(_pip_tasks(chunks, poly_shp, cache)),
+                chunksize=1)
+    finally:
+        if own:
+            pool.close()
+            pool.join()
+    if not pip:
+        return -np.ones(0, dtype=int)
+    return np.concatenate(pip)
+
+def pip_shps_iter(pt_shp, poly_shp, polyID_col=None, empty=None,
+        chunksize=2**20, pool=None, cache=False):
     '''
     Point in polygon operation taking as input a point and a polygon
-    shapefiles
+    shapefiles, streaming over the points
+
+    The point shapefile is read in batches of `chunksize` records and the
+    correspondences of every batch are yielded as soon as they are ready, so
+    memory use does not grow with the number of points. Batches run on the
+    current process or, if `pool` is passed, spread over its workers.
     ...
 
     Arguments
     =========
-    pt_shp          : str
-                      Path to point shapefile
+    pt_shp          : str/GeometryArray
+                      Path to point shapefile, or its geometries already
+                      loaded
+    poly_shp        : str/GeometryArray
+                      Path to polygon shapefile, or its geometries already
+                      loaded (with a pool, the one passed to pip_pool; not
+                      with polyID_col)
+    polyID_col      : str
+                      Name of the column in the polygon shapefile to be used as
+                      ID. If None (default), polygon positions are returned.
+                      Requires poly_shp to be a path
+    empty           : str
+                      Value to insert if the point is not contained in any
+                      polygon and polyID_col is passed. Defaults to None
+    chunksize       : int
+                      Number of points per batch. Defaults to 2**20
+    pool            : multiprocessing.Pool
+                      [Optional] Pool created with pip_pool to process every
+                      batch on multicore
+    cache           : boolean/str
+                      Reuse an on-disk copy of the polygons (see _load_polys).
+                      Defaults to False
+
+    Yields
+    ======
+    correspondences : np.array
+                      Array with one element per point of the batch, in the
+                      order of pt_shp: the polygon ID if polyID_col is passed
+                      or the polygon position (-1 if outside every polygon)
+    '''
+    if polyID_col:
+        ids = _pip_ids_table(poly_shp, polyID_col, empty)
+    if pool is None:
+        pa = _load_polys(poly_shp, cache)
+    for xy in _iter_pts(pt_shp, chunksize):
+        if pool is None:
+            pip = _pip_arrays(xy, pa)
+        else:
+            pip = _pip_multi(xy, poly_shp, pool=pool, cache=cache)
+        if polyID_col:
+            yield ids[pip]
+        else:
+            yield pip
+
+def _iter_pts(pt_shp, chunksize):
+    '''
+    Iterate over the points of a point shapefile (or GeometryArray, or nx2
+    array) in nx2 arrays of at most chunksize rows. Plain point shapefiles (fixed-size
+    records) are read straight from the binary file; any other falls back to
+    pysal.
+    '''
+    if isinstance(pt_shp, (GeometryArray, np.ndarray)):
+        xy = pt_shp.centers() if isinstance(pt_shp, GeometryArray) else \
+                np.asarray(pt_shp, dtype=float).reshape((-1, 2))
+        for start in range(0, xy.shape[0], chunksize):
+            yield xy[start:start+chunksize]
+        return
+    shp = open(pt_shp, 'rb')
+    header = shp.read(100)
+    shape_type = struct.unpack('<i', header[32:36])[0]
+    file_len = struct.unpack('>i', header[24:28])[0] * 2
+    n = (os.path.getsize(pt_shp[:-3] + 'shx') - 100) // 8
+    if shape_type == 1 and file_len == 100 + 28 * n:
+        rec = np.dtype([('head', '>i4', 2), ('type', '<i4'), ('xy', '<f8', 2)])
+        for start in range(0, n, chunksize):
+            recs = np.fromfile(shp, dtype=rec, count=min(chunksize, n - start))
+            yield recs['xy'].astype(float)
+        shp.close()
+    else:
+        shp.close()
+        pts = ps.open(pt_shp)
+        while True:
+            batch = list(itertools.islice(pts, chunksize))
+            if not batch:
+                break
+            yield np.array(batch, dtype=float).reshape((-1, 2))
+        pts.close()
+
+def _check_polyID(poly_shp, polyID_col):
+    'Raise ValueError if polyID_col is passed and poly_shp is not a path'
+    if polyID_col and not isinstance(poly_shp, basestring):
+        raise ValueError("polyID_col needs poly_shp to be the path to a "
+                "shapefile (IDs are read from its dbf), not a %s" % \
+                type(poly_shp).__name__)
+
+def _pip_ids_table(poly_shp, polyID_col, empty):
+    '''
+    Object array with the values of polyID_col in poly_shp followed by
+    `empty`, so indexing it with the output of _pip_arrays maps -1 to `empty`.
+    '''
+    _check_polyID(poly_shp, polyID_col)
+    ids = _dbf_col(poly_shp[:-3] + 'dbf', polyID_col).tolist() + [empty]
+    return np.array(ids, dtype=object)
+
+def _pip2ids(pip, poly_shp, polyID_col, empty):
+    '''
+    Turn the output of _pip_arrays into the list of correspondences returned
+    by the multicore functions: values of polyID_col in poly_shp (`empty` for
+    points outside every polygon) or, if polyID_col is None, polygon positions
+    ('out' for points outside)
+    '''
+    if polyID_col:
+        return _pip_ids_table(poly_shp, polyID_col, empty)[pip].tolist()
+    correspondences = pip.astype(object)
+    correspondences[pip == -1] = 'out'
+    return correspondences.tolist()
+
+def spatial_join(pt_shp, poly_shp, cols=None, out_shp=None, pip=None,
+        pool=None, cache=False):
+    '''
+    Attach the attributes of the polygons of a shapefile to the points that
+    fall in each of them
+
+    Columns of the polygon dbf are decoded once and mapped onto the points
+    with a vectorized take over the point in polygon positions, so any
+    number of columns is attached at once with no Python loop over points.
+    ...
+
+    Arguments
+    =========
+    pt_shp          : str/GeometryArray/np.array
+                      Path to point shapefile, its geometries already loaded
+                      or an nx2 array with xy coordinates
     poly_shp        : str
                       Path to polygon shapefile
+    cols            : list
+                      Names of the columns of the polygon dbf to attach.
+                      Defaults to None (all of them)
+    out_shp         : str
+                      [Optional] Path to the point shapefile to write with the
+                      columns attached. If pt_shp is a shapefile, its dbf is
+                      rewritten with them appended (replacing columns of the
+                      same name) in a single pass and its .shp/.shx/.prj are
+                      hard-linked (or copied); otherwise the points are
+                      written along with a dbf with the columns only
+    pip             : np.array
+                      [Optional] Position of the polygon of every point (-1 if
+                      outside), e.g. from pip_xy_shp, pip_shps_iter or
+                      PolygonIndex.query. If None (default), it is computed
+    pool            : multiprocessing.Pool
+                      [Optional] Pool created with pip_pool to compute pip on
+                      multicore
+    cache           : boolean/str
+                      Reuse an on-disk copy of the polygons (see _load_polys).
+                      Defaults to False
+
+    Returns
+    =======
+    joined          : DataFrame
+                      Table with one row per point, in order, and one column
+                      per polygon column. Points outside every polygon get
+                      missing values (NaN, NaT or None)
+    '''
+    t0 = time.time()
+    if pip is None:
+        if pool is None:
+            pa = _load_polys(poly_shp, cache)
+            pip = [_pip_arrays(xy, pa) for xy in \
+                    _iter_pts(pt_shp, PIP_CHUNK_SIZE)]
+        else:
+            # Chunks of PIP_CHUNK_SIZE points are handed to the workers as
+            # they are read, so all of them are kept busy
+            pip = list(pool.imap(_pip_chunk, _pip_tasks(_iter_pts(pt_shp,
+                    PIP_CHUNK_SIZE), poly_shp, cache)))
+        pip = np.concatenate(pip or [np.zeros(0, dtype=int)])
+        t1 = time.time()
+        print '\t', t1-t0, ' secs to get correspondences'
+        t0 = t1
+    pip = np.asarray(pip)
+    dbh = _dbf_header(poly_shp[:-3] + 'dbf')
+    recs = _dbf_records(poly_shp[:-3] + 'dbf', dbh)
+    specs = _dbf_specs(dbh)
+    if not cols:
+        cols = list(specs)
+    data = OrderedDict()
+    for col in cols:
+        key, ftype, size, dec = specs[col]
+        data[col] = _take_missing(_dbf_decode(recs[key], ftype, dec), pip)
+    joined = pd.DataFrame(data, columns=cols)
+    t1 = time.time()
+    print '\t', t1-t0, ' secs to join attributes'
+    if out_shp:
+        add = []
+        for col in cols:
+            key, ftype, size, dec = specs[col]
+            values = data[col]
+            if ftype == 'L':
+                values = pd.Series(values).map({'T': True, 'F': False}).values
+            add.append((col, (ftype, size, dec), values))
+        _write_pts_cols(pt_shp, out_shp, add)
+        t2 = time.time()
+        print '\t', t2-t1, ' seconds to write shapefile'
+        print 'Shapefile written to %s'%out_shp
+    return joined
+
+def _take_missing(values, idx):
+    '''
+    values[idx] with missing values (NaN, NaT or None) where idx is -1,
+    upcasting integers to float and strings to object if needed
+    '''
+    miss = idx < 0
+    if not values.size:
+        return np.repeat(np.nan, idx.shape[0])
+    out = values.take(np.where(miss, 0, idx))
+    if miss.any():
+        if out.dtype.kind in 'iub':
+            out = out.astype(float)
+        elif out.dtype.kind in 'SU':
+            out = out.astype(object)
+        out[miss] = np.datetime64('NaT') if out.dtype.kind == 'M' else \
+                (np.nan if out.dtype.kind == 'f' else None)
+    return out
+
+def _write_pts_cols(pts, out_shp, add):
+    '''
+    Write a point shapefile with a set of columns
+    ...
+
+    Arguments
+    ---------
+    pts         : str/GeometryArray/np.array
+                  Path to a point shapefile, whose dbf gets the columns
+                  appended (and the rest of files copied), or points
+                  to write along with a dbf with the columns only
+    out_shp     : str
+                  Path to the shapefile to create. If it is pts itself, only
+                  its dbf is rewritten
+    add         : list
+                  (col_name, col_spec, col_data) tuples with the columns, as
+                  in dataIO.editcols2dbf
+    '''
+    if isinstance(pts, basestring):
+        editcols2dbf(pts[:-3] + 'dbf', add=add, dbf_out=out_shp[:-3] + 'dbf')
+        for ext in ['shp', 'shx', 'prj']:
+            src, dst = pts[:-3] + ext, out_shp[:-3] + ext
+            if not os.path.exists(src):
+                continue
+            if os.path.exists(dst):
+                if os.path.abspath(src) == os.path.abspath(dst) or \
+                        (hasattr(os.path, 'samefile') and \
+                        os.path.samefile(src, dst)):
+                    # Writing in place (or over a link to pts)
+                    continue
+                # Unlink first so a hard link at dst is not written through
+                os.remove(dst)
+            copyfile(src, dst)
+        return
+    if isinstance(pts, GeometryArray):
+        pts = pts.centers()
+    _write_pts(np.asarray(pts, dtype=float).reshape((-1, 2)), out_shp)
+    df = pd.DataFrame(OrderedDict([(name, data) for name, spec, data in add]))
+    specs = [spec or _dbf_spec(df[name]) for name, spec, data in add]
+    df2dbf(df, out_shp[:-3] + 'dbf', my_specs=specs)
+
+def _write_pts(xy, shp_out):
+    'Write an array of points as the .shp/.shx of a point shapefile, in bulk'
+    n = xy.shape[0]
+    rec = np.zeros(n, dtype=[('head', '>i4', 2), ('type', '<i4'),
+        ('xy', '<f8', 2)])
+    rec['head'][:, 0] = np.arange(1, n + 1)
+    rec['head'][:, 1] = 10
+    rec['type'] = 1
+    rec['xy'] = xy
+    idx = np.empty((n, 2), dtype='>i4')
+    idx[:, 0] = (100 + 28 * np.arange(n)) // 2
+    idx[:, 1] = 10
+    bbox = [xy[:, 0].min(), xy[:, 1].min(), xy[:, 0].max(),
+            xy[:, 1].max()] if n else [0., 0., 0., 0.]
+    header = struct.pack('>7i', 9994, 0, 0, 0, 0, 0, 0) + \
+            struct.pack('<2i', 1000, 1) + struct.pack('<8d', *(bbox + [0.] * 4))
+    for path, body, length in [(shp_out, rec, 100 + 28 * n),
+            (shp_out[:-3] + 'shx', idx, 100 + 8 * n)]:
+        f = open(path, 'wb')
+        f.write(_shp_header(header, length, bbox))
+        body.tofile(f)
+        f.close()
+
+# Statistics available in pip_aggregate and the suffix of their columns
+AGG_STATS = OrderedDict([('sum', 'SUM'), ('mean', 'AVG'), ('min', 'MIN'),
+    ('max', 'MAX')])
+
+def pip_aggregate(pt_shp, poly_shp, cols=None, stats=('sum', 'mean', 'min',
+        'max'), values=None, dbf_out=None, chunksize=2**20, pool=None,
+        cache=False, names=None):
+    '''
+    Count the points falling in every polygon and aggregate attributes of
+    the points by polygon, streaming over the points
+
+    Points are read in batches of `chunksize` and run through the point in
+    polygon lookup; counts, sums, minima and maxima are accumulated per
+    polygon in preallocated arrays with bincount and grouped reductions, so
+    no per-point result is ever kept.
+    ...
+
+    Arguments
+    =========
+    pt_shp          : str/GeometryArray/np.array
+                      Path to point shapefile, its geometries already loaded
+                      or an nx2 array with xy coordinates
+    poly_shp        : str
+                      Path to polygon shapefile
+    cols            : list
+                      [Optional] Names of numeric columns of the point dbf (or
+                      of `values`) to aggregate. Missing values are skipped
+    stats           : tuple
+                      Statistics computed for every column in cols, out of
+                      'sum', 'mean', 'min' and 'max'. Defaults to all
+    values          : dict/DataFrame
+                      [Optional] Attributes of the points, one value per
+                      point, if pt_shp is not a shapefile
+    dbf_out         : str
+                      [Optional] Path to write the polygon dbf with the
+                      aggregates appended in a single pass (see
+                      dataIO.editcols2dbf). Pass the dbf of poly_shp itself
+                      to update it in place. If None (default), nothing is
+                      written
+    chunksize       : int
+                      Number of points per batch. Defaults to 2**20
+    pool            : multiprocessing.Pool
+                      [Optional] Pool created with pip_pool to run the lookup
+                      on multicore
+    cache           : boolean/str
+                      Reuse an on-disk copy of the polygons (see _load_polys).
+                      Defaults to False
+    names           : dict
+                      [Optional] Prefix of the output columns of some of the
+                      columns in cols (at most six characters to fit a dbf
+                      field name), instead of their first six characters
+
+    Returns
+    =======
+    agg             : DataFrame
+                      Table with one row per polygon, in order, with the
+                      number of points in it ('PT_COUNT') and a column per
+                      column and statistic named as the prefix of the column
+                      (see names), '_' and SUM, AVG, MIN or MAX. Means,
+                      minima and maxima of polygons with no values are NaN.
+                      ValueError is raised up front if a prefix is longer
+                      than six characters, two output columns would share a
+                      name or a column in cols is not in the point dbf (or
+                      in `values`)
+    '''
+    t0 = time.time()
+    cols = list(cols or [])
+    bad = [st for st in stats if st not in AGG_STATS]
+    if bad:
+        raise ValueError("Unknown statistics: %s" % ', '.join(bad))
+    prefix = dict([(col, (names or {}).get(col, col[:6])) for col in cols])
+    over = sorted([p for p in prefix.values() if len(p) > 6])
+    if over:
+        raise ValueError("Prefixes longer than six characters: %s" %
+                ', '.join(over))
+    # Valid dbf field names of 10 characters at most, so no truncation later
+    out = ['PT_COUNT'] + [_dbf_check_name('%s_%s' % (prefix[col],
+            AGG_STATS[st])) for col in cols for st in stats]
+    dup = sorted(set([n for n in out if out.count(n) > 1]))
+    if dup:
+        raise ValueError("Duplicate output columns: %s (pass names to tell "
+                "the columns apart)" % ', '.join(dup))
+    if cols and isinstance(pt_shp, basestring):
+        dbh = _dbf_header(pt_shp[:-3] + 'dbf')
+        specs = _dbf_specs(dbh)
+        missing = [col for col in cols if col not in specs]
+    elif cols:
+        if values is None:
+            raise ValueError("values are needed to aggregate cols if pt_shp "
+                    "is not a shapefile")
+        missing = [col for col in cols if col not in values]
+    else:
+        missing = []
+    if missing:
+        raise ValueError("Columns not found: %s" % ', '.join(missing))
+    if pool is None:
+        pa = _load_polys(poly_shp, cache)
+        m = pa.bbs.shape[0]
+    else:
+        m = _read_shx(poly_shp)[0].shape[0]
+    slabs = {}
+    count = np.zeros(m, dtype=np.int64)
+    acc = dict([(col, [np.zeros(m, dtype=np.int64), np.zeros(m),
+        np.repeat(np.inf, m), np.repeat(-np.inf, m)]) for col in cols])
+    if cols and isinstance(pt_shp, basestring):
+        recs = _dbf_records(pt_shp[:-3] + 'dbf', dbh)
+    start = 0
+    for xy in _iter_pts(pt_shp, chunksize):
+        if pool is None:
+            pip = _pip_arrays(xy, pa, slabs)
+        else:
+            pip = _pip_multi(xy, poly_shp, pool=pool, cache=cache)
+        inside = pip >= 0
+        count += np.bincount(pip[inside], minlength=m)
+        for col in cols:
+            if isinstance(pt_shp, basestring):
+                key, ftype, size, dec = specs[col]
+                v = _dbf_decode(recs[key][start:start+xy.shape[0]], ftype, dec)
+            else:
+                v = np.asarray(values[col])[start:start+xy.shape[0]]
+            v = np.asarray(v, dtype=float)
+            ok = inside & np.isfinite(v)
+            n_ok, sums, mins, maxs = acc[col]
+            n_ok += np.bincount(pip[ok], minlength=m)
+            sums += np.bincount(pip[ok], weights=v[ok], minlength=m)
+            order = np.argsort(pip[ok], kind='mergesort')
+            grp, v = pip[ok][order], v[ok][order]
+            if grp.size:
+                first = np.concatenate(([0], np.flatnonzero(np.diff(grp)) + 1))
+                ids = grp[first]
+                mins[ids] = np.minimum(mins[ids], np.minimum.reduceat(v, first))
+                maxs[ids] = np.maximum(maxs[ids], np.maximum.reduceat(v, first))
+        start += xy.shape[0]
+    t1 = time.time()
+    print '\t', t1-t0, ' secs to aggregate points'
+    agg = OrderedDict([('PT_COUNT', count)])
+    for col in cols:
+        n_ok, sums, mins, maxs = acc[col]
+        empty = n_ok == 0
+        res = {'sum': sums, 'mean': sums / np.where(empty, 1, n_ok),
+                'min': mins, 'max': maxs}
+        for st in stats:
+            r = res[st]
+            if st != 'sum':
+                r[empty] = np.nan
+            agg['%s_%s' % (prefix[col], AGG_STATS[st])] = r
+    agg = pd.DataFrame(agg)
+    if dbf_out:
+        spec = ('N', max(len(str(count.max() if m else 0)), 1), 0)
+        add = [(name, spec if name == 'PT_COUNT' else None, agg[name].values)
+                for name in agg.columns]
+        editcols2dbf(poly_shp[:-3] + 'dbf', add=add, dbf_out=dbf_out)
+        t2 = time.time()
+        print '\t', t2-t1, ' secs to write aggregates to %s'%dbf_out
+    return agg
+
+def _write_pip_shp(pts, out_shp, correspondences, polyID_col):
+    '''
+    Write the points of a pip function with their correspondences in a
+    column named polyID_col (or 'in_poly' if None)
+    '''
+    col = np.empty(len(correspondences), dtype=object)
+    col[:] = correspondences
+    _write_pts_cols(pts, out_shp, [(polyID_col or 'in_poly', None, col)])
+
+def pip_shps(pt_shp, poly_shp, polyID_col=None, out_shp=None, empty='empty',
+        cache=False):
+    '''
+    Point in polygon operation taking as input a point and a polygon
+    shapefiles
+    ...
+
+    Arguments
+    =========
+    pt_shp          : str/GeometryArray
+                      Path to point shapefile, or its geometries already
+                      loaded
+    poly_shp        : str/GeometryArray
+                      Path to polygon shapefile, or its geometries already
+                      loaded
     polyID_col      : str
                       Name of the column in the polygon shapefile to be used as ID
-                      in the output shape
+                      in the output shape. Requires poly_shp to be a path
     out_shp         : str
                       Path to the output shapefile where to write pt_shp with a
                       column with correspondences appended (Optional, defaults to
@@ -258,6 +1886,9 @@ def pip_shps(pt_shp, poly_shp, polyID_col=None, out_shp=None, empty='empty'):
     empty           : str
                       String to insert if the point is not contained in any
                       polygon. Defaults to 'empty'
+    cache           : boolean/str
+                      Reuse an on-disk copy of the polygons (see _load_polys).
+                      Defaults to False
 
     Returns
     =======
@@ -265,52 +1896,24 @@ def pip_shps(pt_shp, poly_shp, polyID_col=None, out_shp=None, empty='empty'):
                       List of length len(pt_shp) with the polygon ID where the
                       points are located
     '''
-    def _poly4pt_pd(pt):
-        'Return the poly where pt is in pandas'
-        x,y = pt
-        candidates = bbs[(bbs['left']<x) & (bbs['right']>x) & \
-                (bbs['down']<y) & (bbs['up']>y)].index
-        for cand in candidates:
-            poly_cand = polys.get(cand)
-            if poly_cand.contains_point(pt)==1:
-                return cand
-        return 'out'
+    _check_polyID(poly_shp, polyID_col)
     t0 = time.time()
-    polys = ps.open(poly_shp)
-    id = []
-    bbs = {'left': [], 'right': [], 'up': [], 'down': []}
-    for c, poly in enumerate(polys):
-        id.append(c)
-        bb = poly.bounding_box
-        bbs['left'].append(bb.left)
-        bbs['right'].append(bb.right)
-        bbs['up'].append(bb.upper)
-        bbs['down'].append(bb.lower)
-    if polyID_col:
-        polyIDs = ps.open(poly_shp[:-3]+'dbf').by_col(polyID_col)
-    bbs = pd.DataFrame(bbs, index=id)
+    pa = _load_polys(poly_shp, cache)
     t1 = time.time()
-    print '\t', t1-t0, ' secs to build bbs'
+    print '\t', t1-t0, ' secs to load polygons and index'
 
-    pts = ps.open(pt_shp)
-    lpts = list(pts)
-    correspondences = map(_poly4pt_pd, lpts)
+    pip = np.concatenate([_pip_arrays(xy, pa) for xy in \
+            _iter_pts(pt_shp, PIP_CHUNK_SIZE)] or [np.zeros(0, dtype=int)])
     t2 = time.time()
     print '\t', t2-t1, ' secs to get correspondences'
-    if polyID_col:
-        correspondences_names= []
-        for i in correspondences:
-            try:
-                correspondences_names.append(polyIDs[int(i)])
-            except:
-                correspondences_names.append(empty)
-        correspondences = correspondences_names
-    pts.close()
-    polys.close()
+    correspondences = _pip2ids(pip, poly_shp, polyID_col, empty)
     t3 = time.time()
     print '\t', t3-t2, ' secs to convert correspondences'
     if out_shp:
-        _writeShp()
+        _write_pip_shp(pt_shp, out_shp, correspondences, polyID_col)
+        t4 = time.time()
+        print '\t', t4-t3, ' seconds to write shapefile'
+        print 'Shapefile written to %s'%out_shp
     return correspondences
 
 def dist_A2B(a, b, metric='euclidean', nearestK=None, multicore=False):
@@ -325,12 +1928,15 @@ def dist_A2B(a, b, metric='euclidean', nearestK=None, multicore=False):
 
     Arguments
     ---------
-    a           : DataFrame
+    a           : DataFrame/GeometryArray
                   Table with points in group A. Every column is each of the
-                  dimensions for the distance to be computed on.
-    b           : DataFrame
+                  dimensions for the distance to be computed on. A
+                  GeometryArray is taken as its points (or bounding box
+                  centres, see GeometryArray.centers) indexed by position
+    b           : DataFrame/GeometryArray
                   Table with points in group B. Every column is each of the
-                  dimensions for the distance to be computed on.
+                  dimensions for the distance to be computed on. A
+                  GeometryArray is taken as in `a`
     metric      : str
                   Desired metric to be used to compute the distance. Defaults to
                   'ecuclidean'. See options at
@@ -339,10 +1945,15 @@ def dist_A2B(a, b, metric='euclidean', nearestK=None, multicore=False):
                   i in A.
     nearestK    : int
                   Number of nearest elements in B to keep the distance from A.
-                  Defaults to None so all are kept.
+                  Defaults to None so all are kept. For metrics in
+                  KNN_METRICS, B is indexed in a KD-tree and all of A is
+                  queried at once, so full distance rows are never built
+                  (multicore is ignored in that case)
     multicore   : boolean
-                  Switcher to span processes to multiple cores. Activating it
-                  (defaults) speeds up the computation but also uses up more memory
+                  Switcher to span processes to multiple cores. B and the
+                  output are placed once in shared memory and every process
+                  works on blocks of A rows, writing its distances straight
+                  into the output. Defaults to False
 
     Returns
     -------
@@ -350,31 +1961,240 @@ def dist_A2B(a, b, metric='euclidean', nearestK=None, multicore=False):
                   Table hierarchically indexed of distances. It uses indices
                   provided in A and B
     '''
+    a, b = _as_frame(a), _as_frame(b)
+    if nearestK and metric in KNN_METRICS:
+        return _a2B_knn(a, b, metric, nearestK)
+    na, nb = a.shape[0], b.shape[0]
+    k = min(nearestK, nb) if nearestK else None
+    shape = (na, k or nb)
     if multicore:
-        pool = mp.Pool(mp.cpu_count())
-        dists = pd.concat(pool.map(_a2B, [(row[1], b, metric, nearestK) for row in a.iterrows()]))
+        out = mp.RawArray('d', na * shape[1])
+        idx = mp.RawArray('l', na * shape[1]) if k else None
     else:
-        dists = pd.concat(map(_a2B, [(row[1], b, metric, nearestK) for row in a.iterrows()]))
-    return dists
-
-def _a2B(aBmetricNearestK):
-    a, B, metric, nearestK = aBmetricNearestK
-    dists = cdist(a.values[None, :], B.values, metric=metric).flatten()
-    id = pd.MultiIndex.from_arrays([np.array([a.name]*B.shape[0]), \
-            B.index.values])
-    s = pd.Series(dists, index=id)
-    if nearestK:
-        _ = s.sort()
-        sk = s[:nearestK]
-        del s
-        return sk
+        out = np.empty(shape)
+        idx = np.empty(shape, dtype=int) if k else None
+    rows = max(1, DIST_BLOCK_CELLS // max(nb, 1))
+    _dist_blocks(a.values, b.values, out, idx, shape, metric, k, rows, nb,
+            multicore)
+    dists = _shared(out, shape).ravel()
+    if k:
+        id = pd.MultiIndex.from_arrays([np.repeat(a.index.values, k), \
+                b.index.values[_shared(idx, shape).ravel()]])
     else:
-        return s
+        id = pd.MultiIndex.from_product([a.index, b.index])
+    return pd.Series(dists, index=id)
 
-def transCRS(db, prj_link, lat='lat', lon='lon'):
+def _as_frame(pts):
+    'DataFrame of x, y of the points of a GeometryArray; anything else as is'
+    if isinstance(pts, GeometryArray):
+        return pd.DataFrame(pts.centers(), columns=['x', 'y'])
+    return pts
+
+def dist_A2B_tiled(a, b, out_npy, metric='euclidean', mem_budget=2**28,
+        dtype='float64', multicore=False):
+    '''
+    Calculate distance from every point in A to every point in B into a
+    memory-mapped matrix on disk, so the result can be larger than RAM.
+
+    The |A|x|B| matrix is computed with scipy.spatial.cdist over tiles of A
+    rows by B columns small enough to fit `mem_budget` and every tile is
+    written straight to `out_npy`, a .npy file. Rows and columns of the
+    matrix are the positions of the points in A and B; their original
+    indices are saved next to it. Use open_dist to slice it lazily.
+
+    NOTE: it assumes coordinates in A and B projected
+    ...
+
+    Arguments
+    ---------
+    a           : DataFrame/GeometryArray
+                  Table with points in group A. Every column is each of the
+                  dimensions for the distance to be computed on (see
+                  dist_A2B for GeometryArray)
+    b           : DataFrame/GeometryArray
+                  Table with points in group B. Every column is each of the
+                  dimensions for the distance to be computed on
+    out_npy     : str
+                  Path to the .npy file to write the distance matrix to. The
+                  indices of A and B are written to the same path ending in
+                  '_rows.npy' and '_cols.npy'
+    metric      : str
+                  Desired metric to be used to compute the distance. Defaults
+                  to 'euclidean'. See options in scipy.spatial.distance.cdist
+    mem_budget  : int
+                  Approximate number of bytes of memory to use per tile.
+                  Defaults to 256MB
+    dtype       : str
+                  Data type of the distances stored. Defaults to 'float64'
+    multicore   : boolean
+                  Switcher to span processes to multiple cores, each writing
+                  its tiles straight into out_npy (mem_budget then applies
+                  per process). Defaults to False
+
+    Returns
+    -------
+    out_npy     : str
+                  Path to the distance matrix
+    '''
+    a, b = _as_frame(a), _as_frame(b)
+    na, nb = a.shape[0], b.shape[0]
+    d = np.lib.format.open_memmap(out_npy, mode='w+', dtype=dtype,
+            shape=(na, nb))
+    # cdist output plus the cast to dtype, in float64 cells
+    cells = max(1, mem_budget // 16)
+    cols = max(1, min(nb, cells))
+    rows = max(1, cells // cols)
+    if multicore:
+        del d
+        d = out_npy
+    _dist_blocks(a.values, b.values, d, None, (na, nb), metric, None, rows,
+            cols, multicore)
+    if not multicore:
+        d.flush()
+    del d
+    np.save(out_npy[:-4] + '_rows.npy', a.index.values)
+    np.save(out_npy[:-4] + '_cols.npy', b.index.values)
+    return out_npy
+
+def open_dist(dist_npy):
+    '''
+    Open a distance matrix written by dist_A2B_tiled without loading it
+    ...
+
+    Arguments
+    ---------
+    dist_npy    : str
+                  Path to the .npy file with the distance matrix
+
+    Returns
+    -------
+    d           : np.memmap
+                  Read-only |A|x|B| memory-mapped distance matrix. Only the
+                  slices used are read from disk
+    a_ids       : Index
+                  Index of A, labels for the rows of d
+    b_ids       : Index
+                  Index of B, labels for the columns of d
+    '''
+    d = np.load(dist_npy, mmap_mode='r')
+    a_ids = pd.Index(np.load(dist_npy[:-4] + '_rows.npy',
+        allow_pickle=True))
+    b_ids = pd.Index(np.load(dist_npy[:-4] + '_cols.npy',
+        allow_pickle=True))
+    return d, a_ids, b_ids
+
+# State of _dist_blocks pool workers (see _dist_init)
+_dist_state = {}
+
+def _dist_blocks(av, bv, out, idx, shape, metric, k, rows, cols, multicore):
+    '''
+    Fill a preallocated output with distances from av to bv computed over
+    tiles of `rows` rows of av by `cols` columns of bv, on the current
+    process or spread over all the cores
+    ...
+
+    Arguments
+    ---------
+    av, bv      : np.array
+                  Coordinates of A and B
+    out         : np.array/RawArray/str
+                  Output buffer of `shape`: an array (single process only),
+                  a multiprocessing.RawArray or the path to a .npy file to be
+                  memory-mapped
+    idx         : np.array/RawArray
+                  Output buffer of `shape` for the positions in B of the k
+                  nearest elements, None if k is None
+    shape       : tuple
+                  Shape of out and idx
+    metric      : str
+                  Metric passed to cdist
+    k           : int
+                  If not None, keep only the k nearest elements in B of every
+                  element in A, sorted by distance (requires cols=len(bv))
+    rows, cols  : int
+                  Size of the tiles
+    multicore   : boolean
+                  Switcher to span processes to multiple cores
+    '''
+    av = np.asarray(av, dtype=float)
+    bv = np.ascontiguousarray(bv, dtype=float)
+    tasks = [(i, j, av[i:i+rows]) for i in range(0, av.shape[0], rows) \
+            for j in range(0, bv.shape[0], cols)]
+    if multicore:
+        b = mp.RawArray('d', bv.size)
+        np.ctypeslib.as_array(b)[:] = bv.ravel()
+        pool = mp.Pool(mp.cpu_count(), _dist_init,
+                (b, bv.shape, out, idx, shape, metric, k, cols))
+        try:
+            pool.map(_dist_block, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        state = _dist_vars(bv, bv.shape, out, idx, shape, metric, k, cols)
+        for task in tasks:
+            _dist_block(task, state)
+
+def _shared(buf, shape):
+    '''
+    Array view of an output buffer of _dist_blocks: arrays are returned as
+    they are, RawArrays viewed without copy and paths memory-mapped
+    '''
+    if buf is None or isinstance(buf, np.ndarray):
+        return buf
+    if isinstance(buf, basestring):
+        return np.load(buf, mmap_mode='r+')
+    return np.ctypeslib.as_array(buf).reshape(shape)
+
+def _dist_vars(b, b_shape, out, idx, shape, metric, k, cols):
+    'State of _dist_block as a dict, with the buffers viewed as arrays'
+    return {'b': _shared(b, b_shape), 'out': _shared(out, shape),
+            'idx': _shared(idx, shape), 'metric': metric, 'k': k,
+            'cols': cols}
+
+def _dist_init(b, b_shape, out, idx, shape, metric, k, cols):
+    'Initializer of _dist_blocks workers'
+    _dist_state.update(_dist_vars(b, b_shape, out, idx, shape, metric, k,
+        cols))
+
+def _dist_block(pars, state=None):
+    '''
+    Compute a tile of distances and write it into the output buffer. Uses
+    state if passed, the worker state set up by _dist_init otherwise
+    '''
+    i, j, ab = pars
+    st = state if state is not None else _dist_state
+    d = cdist(ab, st['b'][j:j+st['cols']], metric=st['metric'])
+    if st['k']:
+        nn = np.argsort(d, axis=1, kind='mergesort')[:, :st['k']]
+        st['idx'][i:i+ab.shape[0]] = nn
+        st['out'][i:i+ab.shape[0]] = d[np.arange(ab.shape[0])[:, None], nn]
+    else:
+        st['out'][i:i+ab.shape[0], j:j+d.shape[1]] = d
+
+def _a2B_knn(a, b, metric, nearestK):
+    '''
+    K nearest elements in b for every element in a using a KD-tree over b.
+    Returns the same Series as dist_A2B: hierarchically indexed by (a, b)
+    and sorted by distance within each element of a
+    '''
+    k = min(nearestK, b.shape[0])
+    tree = cKDTree(b.values)
+    d, j = tree.query(a.values, k=k, p=KNN_METRICS[metric])
+    id = pd.MultiIndex.from_arrays([np.repeat(a.index.values, k), \
+            b.index.values[np.asarray(j).ravel()]])
+    return pd.Series(np.asarray(d, dtype=float).ravel(), index=id)
+
+def transCRS(db, prj_link, lat='lat', lon='lon', src_prj=None,
+        chunksize=2**18, multicore=False):
     '''
     Re-project 'lon' and 'lat' columns from WGS84 to prj_link and put it in
     'x' and 'y' columns
+
+    Coordinates are transformed in contiguous chunks straight from the
+    underlying arrays, optionally spread over all the cores. Transformations
+    are built once per process and (source, target) pair and reused in later
+    calls.
     ...
 
     Arguments
@@ -387,33 +2207,78 @@ def transCRS(db, prj_link, lat='lat', lon='lon'):
                   Column name in db for lattitude
     lon         : str
                   Column name in db for longitude
+    src_prj     : str
+                  [Optional] Path to .prj of the coordinates in db. Defaults
+                  to None for WGS84
+    chunksize   : int
+                  Number of points transformed at once. Defaults to 2**18
+    multicore   : boolean
+                  Switcher to span chunks over processes in multiple cores.
+                  Defaults to False
     Returns
     -------
     db          : DataFrame
                   Original DataFrame to which columns 'x' and 'y' have been
                   added with projected coordinates
     '''
-    orig = osr.SpatialReference()
-    orig.SetWellKnownGeogCS("WGS84")
-    target = osr.SpatialReference()
-    #See link for this hack
-    #http://forum.osgearth.org/Proj4-error-No-translation-for-lambert-conformal-conic-to-PROJ-4-format-is-known-td7579032.html
-    wkt = (open(prj_link).read()).replace('Lambert_Conformal_Conic', \
-            'Lambert_Conformal_Conic_2SP')
-    target.ImportFromWkt(wkt)
-    #target.ImportFromWkt(open(prj_link).read()) #original
-    trCRS = osr.CoordinateTransformation(orig, target)
-    prjd_xys = db[['lon', 'lat']].values.tolist()
-    prjd_xys = np.array(trCRS.TransformPoints(prjd_xys))[:, :2]
+    xys = np.ascontiguousarray(db[[lon, lat]].values, dtype=float)
+    chunks = [(xys[i:i+chunksize], prj_link, src_prj) for i in \
+            range(0, xys.shape[0], chunksize)]
+    if multicore:
+        pool = mp.Pool(mp.cpu_count())
+        try:
+            prjd_xys = pool.map(_transform_chunk, chunks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        prjd_xys = map(_transform_chunk, chunks)
+    prjd_xys = np.concatenate(prjd_xys or [np.zeros((0, 2))])
     db['x'] = prjd_xys[:, 0]
     db['y'] = prjd_xys[:, 1]
     return db
 
+# Coordinate transformations built in the current process, keyed by the
+# absolute paths of the (source, target) .prj files (None for WGS84)
+_crs_transforms = {}
+
+def _crs_transform(prj_link, src_prj=None):
+    '''
+    Return the osr.CoordinateTransformation from src_prj (WGS84 if None) to
+    prj_link, building it only the first time it is requested in the process
+    '''
+    key = (src_prj and os.path.abspath(src_prj), os.path.abspath(prj_link))
+    if key not in _crs_transforms:
+        orig = osr.SpatialReference()
+        if src_prj:
+            orig.ImportFromWkt(_read_wkt(src_prj))
+        else:
+            orig.SetWellKnownGeogCS("WGS84")
+        target = osr.SpatialReference()
+        target.ImportFromWkt(_read_wkt(prj_link))
+        _crs_transforms[key] = osr.CoordinateTransformation(orig, target)
+    return _crs_transforms[key]
+
+def _read_wkt(prj_link):
+    '''
+    Read the WKT in a .prj file
+    '''
+    #See link for this hack
+    #http://forum.osgearth.org/Proj4-error-No-translation-for-lambert-conformal-conic-to-PROJ-4-format-is-known-td7579032.html
+    return (open(prj_link).read()).replace('Lambert_Conformal_Conic', \
+            'Lambert_Conformal_Conic_2SP')
+
+def _transform_chunk(pars):
+    'Transform a chunk (nx2 array) of coordinates into an nx2 array'
+    xys, prj_link, src_prj = pars
+    trCRS = _crs_transform(prj_link, src_prj)
+    return np.array(trCRS.TransformPoints(xys), dtype=float)[:, :2]
+
 if __name__ == "__main__":
     import time
     shpp = ps.examples.get_path('columbus.shp')
     shp = ps.open(shpp)
     xy = np.random.random((1000000, 2))
     xy[0] = shp[0].centroid
-    c = pip_xy_shp_multi(xy, shpp)
+    c = pip_xy_shp(xy, shpp)
 
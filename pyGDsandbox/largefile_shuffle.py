@@ -4,65 +4,467 @@ Randomly shuffles the lines of very large text files with minimal memory usage
 __author__  = "Charles R. Schmidtc <schmidtc@gmail.com> "
 '''
 
-import random
+import os
 import math
 import tempfile
+import zlib
+import numpy as np
+import multiprocessing as mp
 
 MAX_SHARD_SIZE_BYTES = 100*1024*1024.0 # 100 MB * 1024 (KB/MB) * 1024(B/KB)
+BUFFER_SIZE = 2**24 # Bytes read from/written to disk at once
+MERGE_BLOCK_LINES = 2**20 # Lines placed in the output in every merge step
+GATHER_BLOCK_LINES = 2**16 # Lines gathered at once by offset_shuffle
 
-def sharded_shuffle(in_name,out_name):
-    global shards
-    infile = open(in_name,'r')
-    infile.seek(0,2)
-    length = infile.tell()
-    infile.seek(0)
-    n_shards = int(math.ceil(length/MAX_SHARD_SIZE_BYTES))
-    shards = [tempfile.TemporaryFile('w+') for i in range(n_shards)]
-
-    print "sharding with %d shards"%n_shards
-    for i,line in enumerate(infile):
-        shard = i%n_shards
-        shards[shard].write(line)
+def sharded_shuffle(in_name, out_name, cores=None, seed=None, tmp_dir=None):
+    '''
+    Shuffle the lines of in_name into out_name.
+
+    The input is dealt round-robin into temporary shards of up to
+    MAX_SHARD_SIZE_BYTES, every shard is shuffled in memory (concurrently
+    in a pool of `cores` processes) and the shards are merged by drawing,
+    for every block of MERGE_BLOCK_LINES output lines, how many come from
+    each shard given the lines it has left. The result is a uniform random
+    permutation of the lines whatever the size of the shards. A last line
+    without a newline gets one.
+
+    Arguments
+    ---------
+    in_name     : str
+                  Path to the input text file
+    out_name    : str
+                  Path to the output text file
+    cores       : int
+                  Number of processes shuffling shards. Defaults to all the
+                  CPUs available
+    seed        : int
+                  Seed of the random number generator, for reproducible
+                  shuffles. Defaults to None
+    tmp_dir     : str
+                  Folder for the shards. Defaults to the system's temporary
+                  folder
+    '''
+    rs = np.random.RandomState(seed)
+    length = os.path.getsize(in_name)
+    n_shards = max(int(math.ceil(length/MAX_SHARD_SIZE_BYTES)), 1)
+    shards = []
+    try:
+        for i in range(n_shards):
+            fd, path = tempfile.mkstemp(suffix='.shard', dir=tmp_dir)
+            os.close(fd)
+            shards.append(path)
+
+        print "sharding with %d shards"%n_shards
+        info = _deal(in_name, shards)
+
+        print "shuffling"
+        seeds = rs.randint(2**31 - 1, size=n_shards)
+        jobs = zip(shards, seeds)
+        if cores is None:
+            cores = mp.cpu_count()
+        if cores > 1 and n_shards > 1:
+            pool = mp.Pool(min(cores, n_shards))
+            counts = pool.map(_shuffle_shard, jobs, chunksize=1)
+            pool.close()
+            pool.join()
+        else:
+            counts = map(_shuffle_shard, jobs)
+        if counts != info:
+            raise IOError("Shards changed while shuffling: %s lines dealt, "
+                          "%s shuffled" % (info, counts))
+
+        print "writing"
+        _merge(shards, info, out_name, rs)
+    finally:
+        for path in shards:
+            if os.path.exists(path):
+                os.remove(path)
+
+def _lines(f, bufsize=BUFFER_SIZE):
+    '''
+    Read a binary file in blocks of about `bufsize` bytes, yielding lists
+    of the complete lines in each (without their newline)
+    '''
+    tail = ''
+    while True:
+        data = f.read(bufsize)
+        if not data:
+            break
+        lines = (tail + data).split('\n')
+        tail = lines.pop()
+        yield lines
+    if tail:
+        yield [tail]
+
+def _deal(in_name, shards):
+    '''
+    Deal the lines of in_name round-robin into the files in shards and
+    return the number of lines written to each
+    '''
+    n_shards = len(shards)
+    outs = [open(path, 'wb', 2**20) for path in shards]
+    info = [0] * n_shards
+    infile = open(in_name, 'rb')
+    done = 0
+    for lines in _lines(infile):
+        for s in range(n_shards):
+            part = lines[(s - done) % n_shards::n_shards]
+            if part:
+                outs[s].write('\n'.join(part) + '\n')
+                info[s] += len(part)
+        done += len(lines)
     infile.close()
+    for o in outs:
+        o.close()
+    return info
+
+def _shuffle_shard(job):
+    '''
+    Shuffle in place the lines of a shard file with a given seed and
+    return their number
+    '''
+    path, seed = job
+    f = open(path, 'rb')
+    lines = f.read().split('\n')
+    f.close()
+    lines.pop()
+    perm = np.random.RandomState(seed).permutation(len(lines))
+    lines = np.array(lines, dtype=object)[perm]
+    f = open(path, 'wb', BUFFER_SIZE)
+    if len(lines):
+        f.write('\n'.join(lines) + '\n')
+    f.close()
+    return len(lines)
 
-    info = {}
-    for i,shard in enumerate(shards):
-        print "shuffling",i
-        shard.flush()
-        shard.seek(0)
-        lines = shard.readlines()
-        info[i] = len(lines)
-        random.shuffle(lines)
-
-        shard.seek(0)
-        shard.truncate(0)
-        shard.writelines(lines)
-        shard.seek(0)
-
-    o = open(out_name,'w')
+class _ShardReader(object):
+    '''
+    Sequential reader of the lines of a shard, in buffered blocks
+    '''
+    def __init__(self, path, bufsize):
+        self.f = open(path, 'rb')
+        self.blocks = _lines(self.f, bufsize)
+        self.lines = []
+        self.pos = 0
+
+    def take(self, k):
+        'Next k lines of the shard (without their newline)'
+        while len(self.lines) - self.pos < k:
+            self.lines = self.lines[self.pos:] + next(self.blocks)
+            self.pos = 0
+        out = self.lines[self.pos:self.pos+k]
+        self.pos += k
+        return out
+
+    def close(self):
+        self.f.close()
+
+def _merge_counts(rs, left, size):
+    '''
+    Number of lines each shard contributes to the next `size` lines of a
+    uniform interleaving, given the lines `left` in each shard (a
+    multivariate hypergeometric draw, as a chain of univariate ones)
+    '''
+    take = np.zeros_like(left)
+    rest = left.sum()
+    for i in range(left.shape[0]):
+        if not size:
+            break
+        rest -= left[i]
+        if not rest:
+            take[i] = size
+        elif left[i]:
+            take[i] = rs.hypergeometric(left[i], rest, size)
+        size -= take[i]
+    return take
+
+def _merge(shards, info, out_name, rs):
+    '''
+    Interleave the (shuffled) shards into out_name, block by block, in a
+    uniformly random order of shards weighted by their remaining lines
+    '''
+    left = np.array(info, dtype=np.int64)
+    bufsize = max(BUFFER_SIZE // len(shards), 2**16)
+    readers = [_ShardReader(path, bufsize) for path in shards]
+    o = open(out_name, 'wb', BUFFER_SIZE)
+    while left.sum():
+        take = _merge_counts(rs, left, min(MERGE_BLOCK_LINES, left.sum()))
+        left -= take
+        seq = np.repeat(np.arange(len(shards)), take)
+        rs.shuffle(seq)
+        lines = []
+        for i in np.flatnonzero(take):
+            lines.extend(readers[i].take(take[i]))
+        block = np.empty(seq.shape[0], dtype=object)
+        block[np.argsort(seq, kind='mergesort')] = lines
+        o.write('\n'.join(block) + '\n')
+    o.close()
+    for r in readers:
+        r.close()
+
+def offset_shuffle(in_name, out_name, seed=None):
+    '''
+    Shuffle the lines of in_name into out_name through an index of the
+    offsets where lines start, with no temporary files.
+
+    The file is memory-mapped and scanned once, in blocks, for newlines.
+    The line offsets (8 bytes per line) are permuted with a seeded random
+    number generator and the lines gathered into the output in blocks of
+    GATHER_BLOCK_LINES, each read in file order to keep disk and page cache
+    access as sequential as possible. Meant for files whose offsets fit in
+    memory even if their text does not. A last line without a newline gets
+    one.
+
+    Arguments
+    ---------
+    in_name     : str
+                  Path to the input text file
+    out_name    : str
+                  Path to the output text file
+    seed        : int
+                  Seed of the random number generator. The same seed and
+                  input always give the same output. Defaults to None
+    '''
+    o = open(out_name, 'wb', BUFFER_SIZE)
+    if not os.path.getsize(in_name):
+        o.close()
+        return
+    m = np.memmap(in_name, dtype=np.uint8, mode='r')
+    print "indexing"
+    offsets = _line_offsets(m)
+    n = offsets.shape[0] - 1
+    print "shuffling %d lines"%n
+    perm = np.random.RandomState(seed).permutation(n)
     print "writing"
-    while shards:
-        shard = random.randrange(0,n_shards)
-        line = shards[shard].readline()
-        if line:
-            o.write(line)
+    for start in range(0, n, GATHER_BLOCK_LINES):
+        lines = perm[start:start+GATHER_BLOCK_LINES]
+        src = offsets[lines]
+        lens = offsets[lines + 1] - src - 1
+        dst = np.cumsum(lens + 1) - lens - 1
+        block = np.empty(dst[-1] + lens[-1] + 1, dtype=np.uint8)
+        block[dst + lens] = 10
+        order = np.argsort(src)
+        src, dst, lens = src[order], dst[order], lens[order]
+        block[_ranges(dst, lens)] = m[_ranges(src, lens)]
+        o.write(block.tostring())
+    o.close()
+    del m
+
+def _line_offsets(m, bufsize=BUFFER_SIZE):
+    '''
+    Offsets where every line of a memory-mapped file starts, plus one past
+    the end of the last line as if it ended with a newline
+    '''
+    size = m.shape[0]
+    offsets = [np.zeros(1, dtype=np.int64)]
+    for start in range(0, size, bufsize):
+        nl = np.flatnonzero(m[start:start+bufsize] == 10)
+        offsets.append(nl.astype(np.int64) + start + 1)
+    offsets = np.concatenate(offsets)
+    if offsets[-1] != size:
+        offsets = np.append(offsets, size + 1)
+    return offsets
+
+def _ranges(starts, lens):
+    'Concatenation of arange(s, s + l) for every start s and length l'
+    idx = np.arange(lens.sum(), dtype=np.int64)
+    return idx + np.repeat(starts - np.cumsum(lens) + lens, lens)
+
+def reservoir_sample(in_name, out_name, k, seed=None, header=False):
+    '''
+    Write a uniform random sample of k lines of in_name (without
+    replacement) into out_name, in a single pass and holding no more than
+    k lines (plus one block of input) in memory.
+
+    Every line gets a random key and the k lines with the smallest keys are
+    kept, so lines of each block of input are only looked at if their key
+    beats the current reservoir. The sample is written in the order the
+    lines appear in in_name.
+
+    Arguments
+    ---------
+    in_name     : str
+                  Path to the input text file
+    out_name    : str
+                  Path to the output text file
+    k           : int
+                  Size of the sample. All the lines are written if in_name
+                  has fewer
+    seed        : int
+                  Seed of the random number generator. Defaults to None
+    header      : boolean
+                  If True, the first line of in_name is a header: it is
+                  always written first and never sampled. Defaults to False
+
+    Returns
+    -------
+    n           : int
+                  Number of lines sampled (not counting the header)
+    '''
+    rs = np.random.RandomState(seed)
+    infile, head = _open_body(in_name, header)
+    keys = np.empty(0)
+    pos = np.empty(0, dtype=np.int64)
+    kept = np.empty(0, dtype=object)
+    done = 0
+    for lines in _lines(infile):
+        u = rs.random_sample(len(lines))
+        if keys.shape[0] < k:
+            new = np.arange(len(lines))
+        elif k:
+            new = np.flatnonzero(u < keys.max())
         else:
-            print "closing shard"
-            shards[shard].close()
-            shards.pop(shard)
-            n_shards = len(shards)
+            break
+        if new.shape[0]:
+            keys = np.concatenate((keys, u[new]))
+            pos = np.concatenate((pos, new + done))
+            kept = np.concatenate((kept, np.array(lines, dtype=object)[new]))
+            if keys.shape[0] > k:
+                best = np.argpartition(keys, k - 1)[:k]
+                keys, pos, kept = keys[best], pos[best], kept[best]
+        done += len(lines)
+    infile.close()
+    o = open(out_name, 'wb', BUFFER_SIZE)
+    o.write(head)
+    if kept.shape[0]:
+        o.write('\n'.join(kept[np.argsort(pos)]) + '\n')
     o.close()
+    return kept.shape[0]
+
+def split_lines(in_name, out_names, weights=None, seed=None, header=False,
+                by_hash=False, key_col=None, delimiter=','):
+    '''
+    Randomly route every line of in_name into one of several output files
+    (e.g. a train/test split or a k-way partition) in a single pass with
+    bounded memory.
+
+    Arguments
+    ---------
+    in_name     : str
+                  Path to the input text file
+    out_names   : list
+                  Paths to the output text files
+    weights     : list
+                  Expected share of the lines going to every output (it is
+                  normalized to add up to one). Defaults to None (equal
+                  shares)
+    seed        : int
+                  Seed of the random number generator. Defaults to None
+    header      : boolean
+                  If True, the first line of in_name is a header and is
+                  written at the top of every output. Defaults to False
+    by_hash     : boolean
+                  If True, lines are routed by a hash (CRC32) of their
+                  content instead of at random, so the same line (or key)
+                  always goes to the same output whatever the seed or the
+                  rest of the file. Defaults to False
+    key_col     : int
+                  Only with by_hash: position of the column to hash, in
+                  lines split by `delimiter`, so all the lines with the
+                  same key end up together. Defaults to None (whole line)
+    delimiter   : str
+                  Column delimiter used with key_col. Defaults to ','
+
+    Returns
+    -------
+    counts      : list
+                  Number of lines written to every output (not counting the
+                  header)
+    '''
+    n = len(out_names)
+    if weights is None:
+        weights = np.ones(n)
+    cum = np.cumsum(weights, dtype=float)
+    cum /= cum[-1]
+    rs = np.random.RandomState(seed)
+    infile, head = _open_body(in_name, header)
+    outs = [open(name, 'wb', max(BUFFER_SIZE // n, 2**16))
+            for name in out_names]
+    for o in outs:
+        o.write(head)
+    counts = [0] * n
+    for lines in _lines(infile):
+        if by_hash:
+            if key_col is None:
+                keys = lines
+            else:
+                keys = [line.split(delimiter)[key_col] for line in lines]
+            u = np.array([zlib.crc32(key) & 0xffffffff for key in keys],
+                         dtype=float) / 2.0**32
+        else:
+            u = rs.random_sample(len(lines))
+        dest = np.minimum(np.searchsorted(cum, u, side='right'), n - 1)
+        lines = np.array(lines, dtype=object)
+        for i in range(n):
+            part = lines[dest == i]
+            if part.shape[0]:
+                outs[i].write('\n'.join(part) + '\n')
+                counts[i] += part.shape[0]
+    infile.close()
+    for o in outs:
+        o.close()
+    return counts
+
+def _open_body(in_name, header):
+    '''
+    Open in_name for reading in binary and, if header is True, read its
+    first line (returned with a trailing newline; '' otherwise)
+    '''
+    infile = open(in_name, 'rb')
+    head = infile.readline() if header else ''
+    if head and not head.endswith('\n'):
+        head += '\n'
+    return infile, head
+
+def _split_names(out_name, n):
+    'Names of n outputs derived from out_name: data.csv -> data.0.csv...'
+    root, ext = os.path.splitext(out_name)
+    return ['%s.%i%s' % (root, i, ext) for i in range(n)]
+
 def print_usage():
-    print "Usage: python largefile_shuffle.py /path/to/input.txt /path/to/output.txt"
+    print "Usage: python largefile_shuffle.py [--offsets] [--seed SEED] [--header] [--sample K | --split W [W ...] [--hash] [--key-col N]] /path/to/input.txt /path/to/output.txt"
 
 if __name__=='__main__':
     import sys,os
-    if len(sys.argv) == 3:
-        i = sys.argv[1]
-        o = sys.argv[2]
-        if not os.path.exists(i):
-            print_usage()
-        else:
-            sharded_shuffle(i,o)
-    else:
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('input', help='Path to the input text file')
+    parser.add_argument('output', help='Path to the output text file (with '
+                        '--split, outputs are named after it: out.0.txt, '
+                        'out.1.txt...)')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--offsets', action='store_true',
+                      help='Shuffle through an in-memory index of line '
+                      'offsets instead of temporary shards')
+    mode.add_argument('--sample', type=int, metavar='K',
+                      help='Write a uniform random sample of K lines instead '
+                      'of shuffling')
+    mode.add_argument('--split', type=float, nargs='+', metavar='W',
+                      help='Route lines at random into one output per weight '
+                      '(e.g. --split 0.8 0.2) instead of shuffling')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed for reproducible results')
+    parser.add_argument('--header', action='store_true',
+                        help='Keep the first line as a header (--sample and '
+                        '--split only)')
+    parser.add_argument('--hash', action='store_true',
+                        help='With --split, route lines by a hash of their '
+                        'content (or of --key-col) instead of at random')
+    parser.add_argument('--key-col', type=int, default=None, metavar='N',
+                        help='With --hash, hash only column N of each line')
+    parser.add_argument('--delimiter', default=',',
+                        help='Column delimiter for --key-col')
+    args = parser.parse_args()
+    if not os.path.exists(args.input):
         print_usage()
+    elif args.sample is not None:
+        reservoir_sample(args.input, args.output, args.sample,
+                         seed=args.seed, header=args.header)
+    elif args.split:
+        split_lines(args.input, _split_names(args.output, len(args.split)),
+                    weights=args.split, seed=args.seed, header=args.header,
+                    by_hash=args.hash, key_col=args.key_col,
+                    delimiter=args.delimiter)
+    elif args.offsets:
+        offset_shuffle(args.input, args.output, seed=args.seed)
+    else:
+        sharded_shuffle(args.input, args.output, seed=args.seed)